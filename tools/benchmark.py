@@ -0,0 +1,338 @@
+"""
+Stage-by-stage benchmarks of the data pipeline, run offline against
+synthetic inputs (see synthetic_data.py).
+
+Each stage runs in its own process, so that its peak memory can be measured
+separately. Inputs are loaded before the clock starts; 'input_rss_mb' is the
+process's memory once they're loaded, which 'peak_rss_mb' includes.
+Results are printed (or saved) as JSON, with progress messages on stderr,
+and can be compared with a baseline results file from an earlier run.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import pickle
+import queue
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import pandas
+
+from tools import case_data_processor
+from tools import case_matrix
+from tools import data_util
+from tools import generate_full_data
+from tools import split
+from tools import synthetic_data
+
+# Scale name: (number of cases, number of distinct locations).
+SCALES = {
+    "100k": (100000, 50000),
+    "1m": (1000000, 50000),
+    "10m": (10000000, 50000),
+}
+
+# A stage is flagged as a regression when it is this many times slower, or
+# uses this many times more memory, than in the baseline.
+DEFAULT_TOLERANCE = 1.25
+
+LATEST_DATA_COLUMNS = ["city", "province", "country", "date_confirmation",
+                       "date_admission_hospital", "latitude", "longitude"]
+
+
+def max_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+
+def read_latest_data(path):
+    return pandas.read_csv(path, usecols=LATEST_DATA_COLUMNS, dtype=str)
+
+
+def prepare_inputs(data_dir, quiet=False):
+    """
+    Derives the intermediate inputs of later stages (the filtered line list
+    and the full case count table) from the synthetic files, once.
+    """
+    line_list_path = os.path.join(data_dir, "line_list.pkl")
+    full_path = os.path.join(data_dir, "full.pkl")
+    if os.path.exists(line_list_path) and os.path.exists(full_path):
+        return
+    if not quiet:
+        print("Preparing intermediate inputs in '" + data_dir + "'...",
+              file=sys.stderr)
+    df = generate_full_data.filter_latest_data(
+        read_latest_data(os.path.join(data_dir, "latestdata.csv")), quiet=True)
+    df = df.rename(columns={"date_confirmation": "date"})
+    df = df[["date", "geoid", "country"]].reset_index(drop=True)
+    with open(line_list_path, "wb") as f:
+        pickle.dump(df, f)
+    latest = data_util.build_case_count_table_from_line_list(df)
+    # Formatting the JHU data writes a side file in the current directory.
+    jhu_path = os.path.abspath(os.path.join(data_dir, "jhu_us.csv"))
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix="benchmark_")
+    try:
+        os.chdir(work_dir)
+        jhu = generate_full_data.prepare_jhu_data(None, jhu_path, quiet=True)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    full = latest.merge(jhu, on="date", how="outer").fillna(0)
+    full = full.set_index("date").astype(int)
+    with open(full_path, "wb") as f:
+        pickle.dump(full, f)
+
+
+def load_pickle(data_dir, name):
+    with open(os.path.join(data_dir, name), "rb") as f:
+        return pickle.load(f)
+
+
+def count_rows(iterable, counter):
+    for item in iterable:
+        counter[0] += 1
+        yield item
+
+
+# Each stage has a loader, called before timing starts, returning the
+# arguments of the runner and the number of input rows (or None when it is
+# only known after running, as for streamed inputs).
+
+def load_filter_latest_data(data_dir, work_dir):
+    df = read_latest_data(os.path.join(data_dir, "latestdata.csv"))
+    return ((df,), len(df))
+
+
+def run_filter_latest_data(df):
+    generate_full_data.filter_latest_data(df, quiet=True)
+
+
+def load_prepare_jhu_data(data_dir, work_dir):
+    path = os.path.join(data_dir, "jhu_us.csv")
+    return ((path,), len(pandas.read_csv(path, usecols=["UID"])))
+
+
+def run_prepare_jhu_data(path):
+    generate_full_data.prepare_jhu_data(None, path, quiet=True)
+
+
+def load_line_list(data_dir, work_dir):
+    df = load_pickle(data_dir, "line_list.pkl")
+    return ((df, work_dir), len(df))
+
+
+def run_build_case_count_table(df, work_dir):
+    data_util.build_case_count_table_from_line_list(df[["date", "geoid"]])
+
+
+def run_slice_by_country(df, work_dir):
+    split.slice_by_country_and_export(df, os.path.join(work_dir, "c"),
+                                      quiet=True)
+
+
+def load_full_table(data_dir, work_dir):
+    full = case_matrix.from_frame(load_pickle(data_dir, "full.pkl"))
+    return ((full, work_dir), len(full.data))
+
+
+def run_slice_by_day(full, work_dir):
+    split.slice_by_day_and_export(full, os.path.join(work_dir, "d"),
+                                  quiet=True, incremental=False)
+
+
+def load_cases_dump(data_dir, work_dir):
+    return ((os.path.join(data_dir, "cases.json"), work_dir), None)
+
+
+def run_extract_location_info(cases_path, work_dir, counter):
+    cases = count_rows(case_data_processor.iter_case_data(cases_path), counter)
+    case_data_processor.extract_location_info(
+        cases, os.path.join(work_dir, "location_info.data"))
+
+
+def run_output_daily_slices(cases_path, work_dir, counter):
+    cases = count_rows(case_data_processor.iter_case_data(cases_path), counter)
+    case_data_processor.output_daily_slices(
+        case_data_processor.prune_cases(cases), os.path.join(work_dir, "d"),
+        incremental=False)
+
+
+STAGES = [
+    ("filter_latest_data", load_filter_latest_data, run_filter_latest_data),
+    ("prepare_jhu_data", load_prepare_jhu_data, run_prepare_jhu_data),
+    ("build_case_count_table_from_line_list", load_line_list,
+     run_build_case_count_table),
+    ("slice_by_country_and_export", load_line_list, run_slice_by_country),
+    ("slice_by_day_and_export", load_full_table, run_slice_by_day),
+    ("extract_location_info", load_cases_dump, run_extract_location_info),
+    ("output_daily_slices", load_cases_dump, run_output_daily_slices),
+]
+
+
+def run_stage_in_process(stage, data_dir, results):
+    (name, load, run) = stage
+    work_dir = tempfile.mkdtemp(prefix="benchmark_")
+    for d in ["c", "d"]:
+        os.makedirs(os.path.join(work_dir, d))
+    # Some stages write side files in the current directory.
+    os.chdir(work_dir)
+    devnull = open(os.devnull, "w")
+    stdout = sys.stdout
+    try:
+        (args, rows) = load(data_dir, work_dir)
+        input_rss = max_rss_mb()
+        counter = [0]
+        if rows is None:
+            args = args + (counter,)
+        # Keep the stages' own progress messages out of the results.
+        sys.stdout = devnull
+        start_cpu = time.process_time()
+        start = time.perf_counter()
+        run(*args)
+        wall = time.perf_counter() - start
+        cpu = time.process_time() - start_cpu
+        sys.stdout = stdout
+        if rows is None:
+            rows = counter[0]
+        results.put({
+            "stage": name,
+            "wall_s": round(wall, 4),
+            "cpu_s": round(cpu, 4),
+            "rows": rows,
+            "rows_per_s": round(rows / wall, 1) if wall > 0 else None,
+            "input_rss_mb": round(input_rss, 1),
+            "peak_rss_mb": round(max_rss_mb(), 1),
+            "peak_worker_rss_mb": round(max_rss_mb(resource.RUSAGE_CHILDREN), 1),
+        })
+    except Exception as e:
+        sys.stdout = stdout
+        results.put({"stage": name, "error": repr(e)})
+    finally:
+        devnull.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_stage(stage, data_dir):
+    results = multiprocessing.Queue()
+    p = multiprocessing.Process(target=run_stage_in_process,
+                                args=(stage, data_dir, results))
+    p.start()
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not p.is_alive():
+                # The stage's process died without reporting (e.g. killed
+                # when running out of memory), unless its result is only
+                # now coming through.
+                try:
+                    result = results.get(timeout=1)
+                except queue.Empty:
+                    result = {"stage": stage[0], "error": "the process "
+                              "exited with code " + str(p.exitcode)}
+                break
+    p.join()
+    return result
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Returns the ratios of each stage's wall time and peak memory to those in
+    the 'baseline' results, and whether any is over 'tolerance'.
+    """
+    base_stages = dict([(s["stage"], s) for s in baseline["stages"]])
+    comparison = []
+    regressed = False
+    for s in results["stages"]:
+        base = base_stages.get(s["stage"])
+        if not base or "error" in s or "error" in base:
+            continue
+        entry = {"stage": s["stage"]}
+        for key in ["wall_s", "peak_rss_mb"]:
+            entry[key + "_ratio"] = round(s[key] / base[key], 3) \
+                if base[key] else None
+        entry["regressed"] = any([r is not None and r > tolerance for r in
+                                  [entry["wall_s_ratio"],
+                                   entry["peak_rss_mb_ratio"]]])
+        regressed = regressed or entry["regressed"]
+        comparison.append(entry)
+    return (comparison, regressed)
+
+
+def run_benchmarks(data_dir, n_cases, n_geoids, n_days=365, seed=0,
+                   stage_names=None, quiet=False):
+    if not quiet:
+        print("Generating synthetic inputs for " + str(n_cases) + " cases "
+              "and " + str(n_geoids) + " locations in '" + data_dir + "'...",
+              file=sys.stderr)
+    synthetic_data.generate_all(data_dir, n_cases, n_geoids, n_days, seed)
+    prepare_inputs(data_dir, quiet=quiet)
+    stages = []
+    for stage in STAGES:
+        if stage_names and stage[0] not in stage_names:
+            continue
+        if not quiet:
+            print("Running '" + stage[0] + "'...", file=sys.stderr)
+        stages.append(run_stage(stage, data_dir))
+    return {
+        "parameters": {"cases": n_cases, "geoids": n_geoids, "days": n_days,
+                       "seed": seed},
+        "cpu_count": multiprocessing.cpu_count(),
+        "python": sys.version.split()[0],
+        "pandas": pandas.__version__,
+        "stages": stages,
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the pipeline's stages on synthetic data.")
+    parser.add_argument("--scale", choices=sorted(SCALES.keys()),
+                        default="100k")
+    parser.add_argument("--cases", type=int, help="overrides the scale")
+    parser.add_argument("--geoids", type=int, help="overrides the scale")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=None,
+                        help="where synthetic inputs are generated and kept")
+    parser.add_argument("--stage", action="append", dest="stages",
+                        choices=[s[0] for s in STAGES],
+                        help="only run this stage (can be repeated)")
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--baseline", help="results file to compare with")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    (n_cases, n_geoids) = SCALES[args.scale]
+    n_cases = args.cases or n_cases
+    n_geoids = args.geoids or n_geoids
+    data_dir = os.path.abspath(args.data_dir or os.path.join(
+        tempfile.gettempdir(), "covid19_benchmark", "_".join(
+            [str(n_cases), str(n_geoids), str(args.days), str(args.seed)])))
+
+    results = run_benchmarks(data_dir, n_cases, n_geoids, args.days,
+                             args.seed, args.stages)
+    regressed = False
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.loads(f.read())
+            f.close()
+        (results["comparison"], regressed) = compare(results, baseline,
+                                                     args.tolerance)
+    out = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
+            f.close()
+    else:
+        print(out)
+    if any(["error" in s for s in results["stages"]]):
+        return 2
+    return 1 if regressed else 0
@@ -1,33 +1,137 @@
 #!/usr/bin/python3
 
+"""
+Computes the latest date each country has data for.
+
+Country slicing records the latest date of each country file it writes in a
+'freshness_index.json' file next to them, along with the file's size and
+modification time. Files whose entry is missing or doesn't match them
+anymore are read backwards from their end for their last date key instead,
+across a process pool.
+Modification times only make sense on the machine that wrote the files, so
+the index is ignored by git.
+"""
+
 import json
+import multiprocessing
 import os
+import re
+
+from tools import precompress
 
 SELF_DIR = os.path.dirname(os.path.realpath(__file__))
 COUNTRIES_DIR = os.path.join(SELF_DIR, "..", "c")
-COUNTRY_FILES = [f for f in os.listdir(COUNTRIES_DIR) if f.endswith(".json")]
+FRESHNESS_INDEX_FILE_NAME = "freshness_index.json"
+
+# Top-level keys of country files are dates, the nested ones are geo IDs.
+DATE_KEY = re.compile(rb'"(\d{4}-\d{2}-\d{2})":')
+
+# Bytes read at a time when scanning a country file backwards.
+SCAN_BLOCK_SIZE = 64 * 1024
+
+# Below this many files, a process pool isn't worth starting.
+MIN_FILES_FOR_POOL = 8
 
-def get_freshness(out_path):
+
+def list_country_files(countries_dir):
+    return sorted([f for f in os.listdir(countries_dir)
+                   if f.endswith(".json") and f not in [
+                       FRESHNESS_INDEX_FILE_NAME,
+                       precompress.MANIFEST_FILE_NAME]])
+
+
+def file_signature(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def load_index(countries_dir):
+    path = os.path.join(countries_dir, FRESHNESS_INDEX_FILE_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        index = json.loads(f.read())
+        f.close()
+    return index
+
+
+def record(countries_dir, latest_dates):
+    """
+    Records the latest date of each of the given country files, a dictionary
+    of file name to date, as they are on disk now.
+    """
+    index = load_index(countries_dir)
+    for (file_name, latest_date) in latest_dates.items():
+        index[file_name] = {
+            "latest": latest_date,
+            "file": file_signature(os.path.join(countries_dir, file_name))}
+    with open(os.path.join(countries_dir, FRESHNESS_INDEX_FILE_NAME), "w") as f:
+        f.write(json.dumps(index, indent=1, sort_keys=True))
+        f.close()
+
+
+def scan_latest_date(path):
+    """
+    Returns the latest date key of a country file, without parsing it. Dates
+    are written in order, so this reads blocks backwards from the end of the
+    file until one holds a date key.
+    """
+    with open(path, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        tail = b""
+        while end > 0:
+            start = max(0, end - SCAN_BLOCK_SIZE)
+            f.seek(start)
+            # Keep the start of the previous block, a key may span both.
+            tail = f.read(end - start) + tail[:32]
+            dates = DATE_KEY.findall(tail)
+            if dates:
+                f.close()
+                return dates[-1].decode()
+            end = start
+        f.close()
+    return ""
+
+
+def get_freshness(out_path, countries_dir=COUNTRIES_DIR, n_workers=None):
     "Returns whether the operation was a success."
-    if len(COUNTRY_FILES) == 0:
-        print("I haven't found any data in " + COUNTRIES_DIR + ", aborting.")
+    country_files = list_country_files(countries_dir) \
+        if os.path.exists(countries_dir) else []
+    if len(country_files) == 0:
+        print("I haven't found any data in " + countries_dir + ", aborting.")
         return False
 
-    country_to_freshness_date = {}
+    index = load_index(countries_dir)
+    latest_dates = {}
+    to_scan = []
+    for country_file in country_files:
+        entry = index.get(country_file)
+        path = os.path.join(countries_dir, country_file)
+        if entry and entry["file"] == file_signature(path):
+            latest_dates[country_file] = entry["latest"]
+        else:
+            to_scan.append(country_file)
 
-    for country_file in COUNTRY_FILES:
-        code = country_file.replace(".json", "")
-        with open(os.path.join(COUNTRIES_DIR, country_file)) as f:
-            data = json.loads(f.read())
-            f.close()
-        latest_date = ""
-        for date in data:
-            if date > latest_date:
-                latest_date = date
-        country_to_freshness_date[code] = latest_date
+    paths = [os.path.join(countries_dir, f) for f in to_scan]
+    if len(paths) < MIN_FILES_FOR_POOL:
+        scanned = [scan_latest_date(p) for p in paths]
+    else:
+        pool = multiprocessing.Pool(n_workers or multiprocessing.cpu_count())
+        scanned = pool.map(scan_latest_date, paths, chunksize=4)
+        pool.close()
+        pool.join()
+    if to_scan:
+        record(countries_dir, dict(zip(to_scan, scanned)))
+        latest_dates.update(zip(to_scan, scanned))
+
+    country_to_freshness_date = {}
+    for (country_file, latest_date) in latest_dates.items():
+        country_to_freshness_date[country_file.replace(".json", "")] = \
+            latest_date
 
     with open(out_path, "w") as f:
         f.write(json.dumps(country_to_freshness_date, sort_keys=True))
         f.close()
+    precompress.precompress([out_path])
 
     return True
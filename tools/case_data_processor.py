@@ -1,9 +1,22 @@
+import array
+import functools
 import json
+import multiprocessing
 import os
 
-import country_converter
+import numpy
+
 import geo_util
+from tools import case_matrix
+from tools import country_resolution
 from tools import data_util
+from tools import delta_slices
+from tools import downloader
+from tools import instrumentation
+from tools import location_index
+from tools import precompress
+from tools import rollups
+from tools import slice_manifest
 
 LAT_LNG_DECIMAL_PLACES = 4
 LOCATION_INFO_KEYS = ["administrativeAreaLevel" + str(n) for n in [1, 2, 3]]
@@ -20,16 +33,22 @@ def get_confirm_date(case):
 
 def normalize_geo_id(in_geo_id):
     (lat, lng) = [float(l) for l in in_geo_id.split("|")]
-    return geo_util.make_geoid(lat, lng)
+    return make_geoid(lat, lng)
 
 def get_geo_id(case):
     if "location" not in case or "geometry" not in case["location"]:
         return None
     lat = case["location"]["geometry"]["latitude"]
     lng = case["location"]["geometry"]["longitude"]
-    return geo_util.make_geoid(lat, lng)
+    return make_geoid(lat, lng)
     # return normalize_latlng(lat) + "|" + normalize_latlng(lng)
 
+# The same few locations come up over and over again in the cases, so only
+# format each of them once.
+@functools.lru_cache(maxsize=None)
+def make_geoid(lat, lng):
+    return geo_util.make_geoid(lat, lng)
+
 def load_case_data(file_path):
     lines = []
     with open(file_path) as f:
@@ -37,6 +56,51 @@ def load_case_data(file_path):
         f.close()
     return cases
 
+def iter_case_data(file_path):
+    """
+    Yields the cases of a JSON dump (a top-level array of cases) one by one,
+    without holding the whole dump in memory. 'file_path' can also point to
+    a .tar.gz archive containing the dump, which is then read as a stream
+    without being extracted to disk.
+    """
+    if file_path.endswith(".tar.gz") or file_path.endswith(".tgz"):
+        with downloader.open_archive_member(
+                file_path, lambda name: name.endswith(".json")) as stream:
+            yield from iter_json_array(stream)
+        return
+    with open(file_path) as f:
+        yield from iter_json_array(f)
+        f.close()
+
+def iter_json_array(stream, chunk_size=1 << 20):
+    """Yields the elements of the JSON array read from a text stream."""
+    decoder = json.JSONDecoder()
+    buf = stream.read(chunk_size).lstrip()
+    if not buf.startswith("["):
+        raise ValueError("Expected a JSON array")
+    pos = 1
+    eof = False
+    while True:
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buf) and buf[pos] == "]":
+            return
+        try:
+            (element, end) = decoder.raw_decode(buf, pos)
+            # A value ending right at the end of the buffer might be cut
+            # short, e.g. a number.
+            if end < len(buf) or eof:
+                yield element
+                pos = end
+                continue
+        except json.JSONDecodeError:
+            if eof:
+                raise
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+
 def add_or_replace_if_more_precise(data, geo_id, loc_info):
     if geo_id not in data:
         data[geo_id] = loc_info
@@ -48,127 +112,272 @@ def add_or_replace_if_more_precise(data, geo_id, loc_info):
         data[geo_id] = loc_info
 
 def extract_location_info(cases, out_path):
-    geo_id_to_location_info = {}
-    # Start by reading the existing data
-    with open(out_path) as f:
-        lines = f.readlines()
-        f.close()
-    print("Reading " + str(len(lines)) + " of existing location data...")
-    for l in lines:
-        (geo_id, loc_info) = l.strip().split(":", 1)
-        geo_id = normalize_geo_id(geo_id)
-        geo_id_to_location_info[geo_id] = loc_info
-    print("Processing " + str(len(cases)) + " cases...")
-    cases_without_country = 0
-    example_countryless_case = None
-    for c in cases:
-        geo_id = get_geo_id(c)
-        loc = c["location"]
-        info = []
-        if "country" not in loc:
-            if "administrativeAreaLevel1" in loc and loc["administrativeAreaLevel1"].lower() == "taiwan":
-                loc["country"] = "Taiwan"
-            else:
-                cases_without_country += 1
-                if not example_countryless_case:
-                    example_countryless_case = c
+    with instrumentation.stage("extract_location_info") as stage:
+        # Collect the most precise info for each geo ID in the cases first, so
+        # that the index only gets looked up once per geo ID.
+        geo_id_to_location_info = {}
+        cases_without_country = 0
+        example_countryless_case = None
+        case_count = 0
+        for c in cases:
+            case_count += 1
+            geo_id = get_geo_id(c)
+            loc = c["location"]
+            info = []
+            if "country" not in loc:
+                if "administrativeAreaLevel1" in loc and loc["administrativeAreaLevel1"].lower() == "taiwan":
+                    loc["country"] = "Taiwan"
+                else:
+                    cases_without_country += 1
+                    if not example_countryless_case:
+                        example_countryless_case = c
+                    continue
+            country_code = country_resolution.code_from_name(loc["country"])
+            if not country_code:
                 continue
-        country_code = country_converter.code_from_name(loc["country"])
-        if not country_code:
-            continue
-        for k in LOCATION_INFO_KEYS:
-            if k in loc:
-                info.append(loc[k])
-        info.append(country_code)
-        add_or_replace_if_more_precise(
-            geo_id_to_location_info, geo_id, "|".join(info))
-
-    output = []
-    if cases_without_country > 0:
-        print("Warning, " + str(cases_without_country) + " "
-              "cases didn't have a country. Here is an example:")
-        print(example_countryless_case)
-    for geo_id in geo_id_to_location_info:
-        output.append(geo_id + ":" + geo_id_to_location_info[geo_id])
-
-    with open(out_path, "w") as f:
-        f.write("\n".join(output))
-        f.close()
+            for k in LOCATION_INFO_KEYS:
+                if k in loc:
+                    info.append(loc[k])
+            info.append(country_code)
+            add_or_replace_if_more_precise(
+                geo_id_to_location_info, geo_id, "|".join(info))
+
+        print("Processed " + str(case_count) + " cases")
+        stage.rows_in = case_count
+        if cases_without_country > 0:
+            print("Warning, " + str(cases_without_country) + " "
+                  "cases didn't have a country. Here is an example:")
+            print(example_countryless_case)
+
+        # Existing entries may have been written with another rounding, so
+        # all geo IDs go through the same formatting as the cases'.
+        index = location_index.LocationIndex(
+            location_index.index_path_for(out_path), bootstrap_from=out_path,
+            normalize=normalize_geo_id)
+        merged = index.merge(geo_id_to_location_info.items())
+        print("Merged " + str(merged) + " new or more precise locations")
+        stage.rows_out = merged
+        index.export(out_path)
 
 def prune_cases(cases):
     # Let's only keep the data we need. Discard textual location info, it can
-    # be retrieved from the geo ID.
-    pruned_cases = []
+    # be retrieved from the geo ID. This is a generator so that cases can be
+    # streamed through without keeping them all in memory.
     for c in cases:
         if "location" not in c:
             continue
         confirm_date = get_confirm_date(c)
         if not confirm_date:
             continue
-        pruned = {
+        yield {
             "geo_id": get_geo_id(c),
             "date": confirm_date
         }
-        pruned_cases.append(pruned)
-    return pruned_cases
 
 def format_single_feature(geo_id, total, new):
     if new > 0:
         return {"properties": {"geoid": geo_id, "total": total, "new": new}}
     return {"properties": {"geoid": geo_id, "total": total}}
 
-def write_daily_slice_from_accumulator(out_dir, date, acc):
-    out_file = os.path.join(out_dir, date + ".json")
-    print(out_file)
-    out_object = {"date": date, "features": []}
-    # Iterate over sorted keys to minimize file update diffs
-    for geo_id in sorted(acc.keys()):
-        cases = acc[geo_id]
-        out_object["features"].append(format_single_feature(geo_id, cases[0], cases[1]))
-    # print(out_object)
-    with open(out_file, "w") as f:
-        f.write(json.dumps(out_object))
-        f.close()
+# Cases are counted in buffers of this many packed (date, geo ID) codes,
+# which then get folded into the counts so far.
+COUNT_BUFFER_SIZE = 1 << 20
 
-def fold_new_cases_to_total(acc):
-    for geo_id in acc:
-        acc[geo_id][0] += acc[geo_id][1]
-        acc[geo_id][1] = 0
+def fold_pair_counts(keys, counts, buffered):
+    """
+    Adds the packed (date, geo ID) codes in 'buffered' to the sorted unique
+    'keys' and their 'counts', and returns the new keys and counts.
+    """
+    (buffered_keys, buffered_counts) = numpy.unique(
+        numpy.frombuffer(buffered, dtype=numpy.int64), return_counts=True)
+    if len(keys) == 0:
+        return (buffered_keys, buffered_counts.astype(numpy.int64))
+    (keys, inverse) = numpy.unique(numpy.concatenate([keys, buffered_keys]),
+                                   return_inverse=True)
+    return (keys, numpy.bincount(inverse, weights=numpy.concatenate(
+        [counts, buffered_counts])).astype(numpy.int64))
 
-def output_daily_slices(cases, out_dir):
-    # Dict by date, then by geo ID, then an array of [total, new].
-    new_cases_by_date_and_geo_id = {}
-    cases_by_date = {}
+def count_cases(cases, stage):
+    """
+    Counts the cases per date and geo ID. Returns the sorted dates, the
+    sorted geo IDs, and the counts by date as a CSR-like triple of arrays:
+    the entries of the date at position i are in [indptr[i], indptr[i + 1])
+    of 'geo_id_index' (positions in the geo IDs) and 'counts'.
+    """
+    date_codes = {}
+    geo_id_codes = {}
+    keys = numpy.zeros(0, dtype=numpy.int64)
+    counts = numpy.zeros(0, dtype=numpy.int64)
+    buffered = array.array("q")
     for c in cases:
-        date = c["date"]
-        if date not in cases_by_date:
-            cases_by_date[date] = []
-        cases_by_date[date].append(c)
-
-    for date in sorted(cases_by_date.keys()):
-        if date not in new_cases_by_date_and_geo_id:
-            new_cases_by_date_and_geo_id[date] = {}
-        cur_cases = cases_by_date[date]
-        #print(date)
-        for c in cur_cases:
-            geo_id = c["geo_id"]
-            if not geo_id:
-                continue
-            if geo_id not in new_cases_by_date_and_geo_id[date]:
-                new_cases_by_date_and_geo_id[date][geo_id] = 0
-            new_cases_by_date_and_geo_id[date][geo_id] += 1
-
-    # We now have all the new cases. Now we need to accumulate and output
-    # daily slices.
-    # Dict by geo_id where keys are [total, new]
-    acc = {}
-    for date in sorted(cases_by_date.keys()):
-        for geo_id in new_cases_by_date_and_geo_id[date]:
-            if geo_id not in acc:
-                acc[geo_id] = [0, 0]
-            acc[geo_id][1] += new_cases_by_date_and_geo_id[date][geo_id]
-        write_daily_slice_from_accumulator(out_dir, date, acc)
-        fold_new_cases_to_total(acc)
+        stage.rows_in += 1
+        # Cases without a geo ID still make their date appear.
+        date_code = date_codes.setdefault(c["date"], len(date_codes))
+        geo_id = c["geo_id"]
+        if not geo_id:
+            continue
+        buffered.append((date_code << 32) |
+                        geo_id_codes.setdefault(geo_id, len(geo_id_codes)))
+        if len(buffered) >= COUNT_BUFFER_SIZE:
+            (keys, counts) = fold_pair_counts(keys, counts, buffered)
+            buffered = array.array("q")
+    (keys, counts) = fold_pair_counts(keys, counts, buffered)
+
+    # Fix the order of dates and geo IDs once, and sort the counts by date
+    # and geo ID in that order.
+    dates = sorted(date_codes.keys())
+    geo_ids = sorted(geo_id_codes.keys())
+    date_rank = numpy.zeros(len(dates), dtype=numpy.int64)
+    date_rank[[date_codes[d] for d in dates]] = numpy.arange(len(dates))
+    geo_id_rank = numpy.zeros(len(geo_ids), dtype=numpy.int64)
+    geo_id_rank[[geo_id_codes[g] for g in geo_ids]] = numpy.arange(
+        len(geo_ids))
+    keys = (date_rank[keys >> 32] << 32) | geo_id_rank[keys & 0xFFFFFFFF]
+    order = numpy.argsort(keys, kind="stable")
+    keys = keys[order]
+    indptr = numpy.searchsorted(keys >> 32, numpy.arange(len(dates) + 1))
+    return (dates, geo_ids, indptr, keys & 0xFFFFFFFF, counts[order])
+
+# What daily slice workers need to know about the counts, see
+# init_slice_worker.
+_slices = None
+
+def init_slice_worker(out_dir, dates, geo_ids, indptr, geo_id_index, counts,
+                      keyframe_interval):
+    global _slices
+    # The position of the date each geo ID first had cases on.
+    (seen, first_entry) = numpy.unique(geo_id_index, return_index=True)
+    first_seen = numpy.full(len(geo_ids), len(dates), dtype=numpy.int64)
+    first_seen[seen] = numpy.searchsorted(indptr, first_entry,
+                                          side="right") - 1
+    _slices = {"out_dir": out_dir, "dates": dates, "geo_ids": geo_ids,
+               "quoted_geo_ids": [json.dumps(g) for g in geo_ids],
+               "indptr": indptr, "geo_id_index": geo_id_index,
+               "counts": counts, "first_seen": first_seen,
+               "keyframe_interval": keyframe_interval}
+
+def format_full_slice(date, keyframe, seen, totals, new_cases):
+    """
+    Returns the JSON text of a daily slice listing every location seen so
+    far, the same as json.dumps would give, but without building all the
+    features as objects first.
+    """
+    quoted_geo_ids = _slices["quoted_geo_ids"]
+    parts = []
+    for (g, total) in zip(seen.tolist(), totals[seen].tolist()):
+        new = new_cases.get(g, 0)
+        if new > 0:
+            parts.append('{"properties": {"geoid": ' + quoted_geo_ids[g] +
+                         ', "total": ' + str(total) +
+                         ', "new": ' + str(new) + '}}')
+        else:
+            parts.append('{"properties": {"geoid": ' + quoted_geo_ids[g] +
+                         ', "total": ' + str(total) + '}}')
+    # The features come last, so their list can be put in place of the empty
+    # one in the rest of the slice.
+    envelope = json.dumps(delta_slices.encode(
+        {"date": date, "features": []}, keyframe, total_includes_new=False))
+    return envelope[:-len("]}")] + ", ".join(parts) + "]}"
+
+def write_daily_slices_from_counts(positions):
+    """
+    Writes the daily slices of the dates at the given sorted 'positions',
+    with the counts set by init_slice_worker. Returns the written paths.
+    """
+    dates = _slices["dates"]
+    geo_ids = _slices["geo_ids"]
+    indptr = _slices["indptr"]
+    geo_id_index = _slices["geo_id_index"]
+    counts = _slices["counts"]
+    # Totals, which don't include the day's new cases, as of the first date.
+    start = indptr[positions[0]]
+    totals = numpy.bincount(geo_id_index[:start], weights=counts[:start],
+                            minlength=len(geo_ids)).astype(numpy.int64)
+    to_write = set(positions)
+    written = []
+    for i in range(positions[0], positions[-1] + 1):
+        day = slice(indptr[i], indptr[i + 1])
+        if i in to_write:
+            new_cases = dict(zip(geo_id_index[day].tolist(),
+                                 counts[day].tolist()))
+            keyframe = delta_slices.keyframe_for(
+                dates, i, _slices["keyframe_interval"])
+            if keyframe is None or keyframe == dates[i]:
+                seen = numpy.flatnonzero(_slices["first_seen"] <= i)
+                text = format_full_slice(dates[i], keyframe, seen, totals,
+                                         new_cases)
+            else:
+                # Deltas only list the locations with new cases.
+                features = [format_single_feature(geo_ids[g], 0, new_cases[g])
+                            for g in sorted(new_cases.keys())]
+                text = json.dumps(delta_slices.encode(
+                    {"date": dates[i], "features": features}, keyframe,
+                    total_includes_new=False))
+            out_file = os.path.join(_slices["out_dir"], dates[i] + ".json")
+            print(out_file)
+            with open(out_file, "w") as f:
+                f.write(text)
+                f.close()
+            written.append(out_file)
+        totals[geo_id_index[day]] += counts[day]
+    return written
+
+def output_daily_slices(cases, out_dir, incremental=True, sources=None,
+                        keyframe_interval=0, n_workers=None):
+    with instrumentation.stage("count_cases", rows_in=0) as stage:
+        (dates, geo_ids, indptr, geo_id_index, counts) = count_cases(cases,
+                                                                    stage)
+        stage.rows_out = len(counts)
+
+    # Only the dates from the earliest one that changed since the last run
+    # need to be written out again.
+    date_hashes = {}
+    for i in range(len(dates)):
+        day = slice(indptr[i], indptr[i + 1])
+        date_hashes[dates[i]] = slice_manifest.hash_new_cases(zip(
+            [geo_ids[g] for g in geo_id_index[day]], counts[day].tolist()))
+    options = {"keyframe_interval": keyframe_interval}
+    manifest = slice_manifest.empty_manifest(options)
+    if incremental:
+        manifest = slice_manifest.load(out_dir, options)
+    to_rewrite = set(slice_manifest.dates_to_rewrite(manifest, date_hashes,
+                                                     out_dir))
+    print(str(len(to_rewrite)) + " out of " + str(len(date_hashes)) + " "
+          "daily slices have changed.")
+
+    with instrumentation.stage("write_daily_slices",
+                               rows_in=len(to_rewrite)) as stage:
+        positions = [i for i in range(len(dates)) if dates[i] in to_rewrite]
+        written = []
+        if positions:
+            if not n_workers:
+                n_workers = multiprocessing.cpu_count()
+            # A few runs of consecutive dates per worker, since each run
+            # starts by summing up all the cases before it.
+            run_length = max(1, -(-len(positions) // (n_workers * 4)))
+            runs = [positions[k:k + run_length]
+                    for k in range(0, len(positions), run_length)]
+            pool = multiprocessing.Pool(
+                n_workers, initializer=init_slice_worker,
+                initargs=(out_dir, dates, geo_ids, indptr, geo_id_index,
+                          counts, keyframe_interval))
+            for paths in pool.imap(write_daily_slices_from_counts, runs):
+                written += paths
+            pool.close()
+            pool.join()
+        stage.rows_out = len(written)
+
+    with instrumentation.stage("write_rollups", rows_in=len(counts)) as stage:
+        rolled_up = rollups.write_rollups(case_matrix.CaseMatrix(
+            numpy.array(dates, dtype=object),
+            numpy.array(geo_ids, dtype=object), counts, geo_id_index,
+            indptr), out_dir)
+        stage.rows_out = len(rolled_up)
+        written += rolled_up
+
+    slice_manifest.write_index(out_dir, date_hashes.keys())
+    slice_manifest.update(out_dir, manifest, date_hashes, sources)
+    precompress.precompress(written + [os.path.join(out_dir, "index.txt")])
 
 def output_country_slices(cases, out_dir):
     pass
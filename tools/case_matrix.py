@@ -0,0 +1,254 @@
+"""
+A compact on-disk store for the full date x geo ID table of new cases, so
+that later tools and re-runs can query it without reparsing the daily JSON
+slices.
+
+A store is a directory holding:
+  dates.txt      one date per line, sorted
+  geoids.txt     one geo ID per line, sorted
+  data.npy       the non-zero new case counts (int32)
+  indices.npy    the geo ID index of each count (int32)
+  indptr.npy     where each date's counts start in the two arrays above
+
+i.e. the table in compressed sparse row form, one row per date. The arrays
+are memory-mapped when loading, so only the parts being queried are read.
+
+Usage: python3 -m tools.case_matrix STORE_DIR [START_DATE [END_DATE [GEOID...]]]
+prints the matching part of the table as CSV.
+"""
+
+import collections
+import hashlib
+import os
+import shutil
+import sys
+
+import numpy
+import pandas
+
+CaseMatrix = collections.namedtuple(
+    "CaseMatrix", ["dates", "geoids", "data", "indices", "indptr"])
+
+
+def from_frame(df):
+    """
+    Builds a case matrix from a data frame where each row is a date, columns
+    are geo IDs and cells are new case counts.
+    """
+    df = df.sort_index(axis=0).sort_index(axis=1)
+    values = df.to_numpy(dtype=numpy.int64)
+    (rows, cols) = numpy.nonzero(values)
+    indptr = numpy.zeros(len(df.index) + 1, dtype=numpy.int64)
+    indptr[1:] = numpy.cumsum(numpy.bincount(rows, minlength=len(df.index)))
+    return CaseMatrix(
+        numpy.array([str(d) for d in df.index], dtype=object),
+        numpy.array([str(g) for g in df.columns], dtype=object),
+        values[rows, cols].astype(numpy.int32),
+        cols.astype(numpy.int32),
+        indptr)
+
+
+def from_line_list(df):
+    """
+    Builds a case matrix from a line list with "date" and "geoid" columns,
+    where each row is a case, or that many cases if there's a "count"
+    column. Rows with a missing date or geo ID are ignored. Unlike
+    data_util.build_case_count_table_from_line_list, no dense table is ever
+    built, so this takes memory in proportion to the non-zero counts.
+    """
+    (date_codes, dates) = pandas.factorize(df.date, sort=True)
+    (geoid_codes, geoids) = pandas.factorize(df.geoid, sort=True)
+    valid = (date_codes >= 0) & (geoid_codes >= 0)
+    weights = None
+    if "count" in df.columns:
+        weights = df["count"].to_numpy()[valid]
+    return from_coordinates(
+        numpy.array([str(d) for d in dates], dtype=object),
+        numpy.array([str(g) for g in geoids], dtype=object),
+        date_codes[valid], geoid_codes[valid], weights)
+
+
+def from_coordinates(dates, geoids, rows, cols, counts=None):
+    """
+    Builds a case matrix from sorted 'dates' and 'geoids' labels and the
+    (row, column, count) coordinates of its counts. Counts at the same
+    coordinates are summed up, and zeros are dropped. Without 'counts',
+    each coordinate stands for one case.
+    """
+    keys = numpy.asarray(rows, dtype=numpy.int64) * len(geoids) + \
+        numpy.asarray(cols, dtype=numpy.int64)
+    if counts is None:
+        (keys, data) = numpy.unique(keys, return_counts=True)
+    else:
+        (keys, inverse) = numpy.unique(keys, return_inverse=True)
+        data = numpy.bincount(inverse, weights=counts,
+                              minlength=len(keys)).astype(numpy.int64)
+        non_zero = data != 0
+        (keys, data) = (keys[non_zero], data[non_zero])
+    if len(geoids):
+        (rows, cols) = (keys // len(geoids), keys % len(geoids))
+    else:
+        (rows, cols) = (keys, keys)
+    indptr = numpy.zeros(len(dates) + 1, dtype=numpy.int64)
+    indptr[1:] = numpy.cumsum(numpy.bincount(rows, minlength=len(dates)))
+    return CaseMatrix(dates, geoids, data.astype(numpy.int32),
+                      cols.astype(numpy.int32), indptr)
+
+
+def merge(*matrices):
+    """
+    Returns the sum of case matrices, over the union of their dates and geo
+    IDs, computed from their non-zero counts only.
+    """
+    dates = numpy.array(sorted(set().union(*[m.dates for m in matrices])),
+                        dtype=object)
+    geoids = numpy.array(sorted(set().union(*[m.geoids for m in matrices])),
+                         dtype=object)
+    (rows, cols, counts) = ([], [], [])
+    for m in matrices:
+        indptr = numpy.asarray(m.indptr)
+        date_rows = numpy.searchsorted(dates, m.dates)
+        rows.append(numpy.repeat(date_rows, numpy.diff(indptr)))
+        cols.append(numpy.searchsorted(geoids, m.geoids)[
+            numpy.asarray(m.indices)])
+        counts.append(numpy.asarray(m.data, dtype=numpy.int64))
+    return from_coordinates(dates, geoids, numpy.concatenate(rows),
+                            numpy.concatenate(cols), numpy.concatenate(counts))
+
+
+def day(matrix, position):
+    """Returns the geo ID positions and counts of the date at 'position'."""
+    (start, end) = (matrix.indptr[position], matrix.indptr[position + 1])
+    return (numpy.asarray(matrix.indices[start:end]),
+            numpy.asarray(matrix.data[start:end]))
+
+
+def totals_before(matrix, position):
+    """
+    Returns the cumulative counts of every geo ID over the dates before the
+    one at 'position'.
+    """
+    end = matrix.indptr[position]
+    return numpy.bincount(numpy.asarray(matrix.indices[:end]),
+                          weights=numpy.asarray(matrix.data[:end]),
+                          minlength=len(matrix.geoids)).astype(numpy.int64)
+
+
+def first_seen(matrix):
+    """
+    Returns, for each geo ID, the position of the first date it has counts
+    on, or the number of dates if it has none.
+    """
+    (seen, first_entry) = numpy.unique(numpy.asarray(matrix.indices),
+                                       return_index=True)
+    positions = numpy.full(len(matrix.geoids), len(matrix.dates),
+                           dtype=numpy.int64)
+    positions[seen] = numpy.searchsorted(numpy.asarray(matrix.indptr),
+                                         first_entry, side="right") - 1
+    return positions
+
+
+def content_hash(matrix):
+    """Returns a content hash of the matrix's labels and counts."""
+    h = hashlib.sha1()
+    for labels in [matrix.dates, matrix.geoids]:
+        h.update("\n".join(labels).encode())
+        h.update(b"\0")
+    for name in ["data", "indices", "indptr"]:
+        h.update(numpy.ascontiguousarray(
+            getattr(matrix, name), dtype=numpy.int64).tobytes())
+    return h.hexdigest()
+
+
+def save(matrix, store_dir):
+    """
+    Writes the matrix to 'store_dir', replacing any previous store there only
+    once the new one is complete.
+    """
+    tmp_dir = store_dir.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for (name, labels) in [("dates", matrix.dates), ("geoids", matrix.geoids)]:
+        with open(os.path.join(tmp_dir, name + ".txt"), "w") as f:
+            f.write("\n".join(labels))
+            f.close()
+    for name in ["data", "indices", "indptr"]:
+        numpy.save(os.path.join(tmp_dir, name + ".npy"), getattr(matrix, name))
+
+    old_dir = store_dir.rstrip("/") + ".old"
+    if os.path.exists(store_dir):
+        os.rename(store_dir, old_dir)
+    os.rename(tmp_dir, store_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def load(store_dir, mmap=True):
+    labels = []
+    for name in ["dates", "geoids"]:
+        with open(os.path.join(store_dir, name + ".txt")) as f:
+            labels.append(numpy.array([l for l in f.read().split("\n") if l],
+                                      dtype=object))
+            f.close()
+    arrays = [numpy.load(os.path.join(store_dir, name + ".npy"),
+                         mmap_mode="r" if mmap else None)
+              for name in ["data", "indices", "indptr"]]
+    return CaseMatrix(labels[0], labels[1], *arrays)
+
+
+def query(matrix, start_date=None, end_date=None, geoids=None):
+    """
+    Returns the new cases between 'start_date' and 'end_date' (both included,
+    and both optional) as a data frame of dates x geo IDs. If 'geoids' is
+    given, only those columns are returned; unknown geo IDs are all zeros.
+    """
+    first = 0
+    last = len(matrix.dates)
+    if start_date:
+        first = numpy.searchsorted(matrix.dates, start_date, side="left")
+    if end_date:
+        last = numpy.searchsorted(matrix.dates, end_date, side="right")
+    last = max(first, last)
+    start = matrix.indptr[first]
+    end = matrix.indptr[last]
+    data = numpy.asarray(matrix.data[start:end])
+    cols = numpy.asarray(matrix.indices[start:end])
+    rows = numpy.repeat(numpy.arange(last - first),
+                        numpy.diff(numpy.asarray(matrix.indptr[first:last + 1])))
+
+    columns = matrix.geoids
+    if geoids is not None:
+        columns = numpy.array(list(geoids), dtype=object)
+        positions = geoid_positions(matrix, columns)
+        # Map each stored geo ID index to its position in the output, or -1.
+        remap = numpy.full(len(matrix.geoids), -1, dtype=numpy.int64)
+        found = positions >= 0
+        remap[positions[found]] = numpy.flatnonzero(found)
+        cols = remap[cols]
+        keep = cols >= 0
+        (rows, cols, data) = (rows[keep], cols[keep], data[keep])
+
+    values = numpy.zeros((last - first, len(columns)), dtype=numpy.int64)
+    values[rows, cols] = data
+    out = pandas.DataFrame(values, index=matrix.dates[first:last],
+                           columns=columns)
+    out.index.name = "date"
+    return out
+
+
+def geoid_positions(matrix, geoids):
+    """Returns the index of each of 'geoids' in the matrix, or -1."""
+    geoids = numpy.array(list(geoids), dtype=object)
+    positions = numpy.searchsorted(matrix.geoids, geoids)
+    positions[positions >= len(matrix.geoids)] = 0
+    found = matrix.geoids[positions] == geoids if len(matrix.geoids) else \
+        numpy.zeros(len(geoids), dtype=bool)
+    return numpy.where(found, positions, -1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    args = sys.argv[2:] + [None, None]
+    query(load(sys.argv[1]), args[0], args[1],
+          sys.argv[4:] or None).to_csv(sys.stdout)
@@ -0,0 +1,98 @@
+"""
+Memoized resolution of country names to ISO codes, on top of the common
+repo's country_converter.
+
+Ingestion paths see the same few hundred country names over and over, so
+each distinct name is only resolved once: names are normalized (quotes and
+extra whitespace removed) and their resolution kept in a bounded cache.
+Names keep their case, so each caller asks country_converter with the case
+it used to: country slicing lowercases its names, the other callers don't.
+codes_from_names() resolves a whole list or pandas Series at once, going
+through each distinct name only once.
+
+How often the cache helped, and which names couldn't be resolved, are
+reported in the run report's "stats" (see instrumentation.py).
+"""
+
+import collections
+import functools
+
+import numpy
+import pandas
+
+import country_converter
+
+from tools import instrumentation
+
+MAX_CACHED_NAMES = 4096
+# How many of the most frequent unresolved names the stats list.
+MAX_REPORTED_UNRESOLVED = 20
+
+_lookups = 0
+_unresolved = collections.Counter()
+
+
+def normalize(name):
+    return " ".join(str(name).replace('"', "").split())
+
+
+@functools.lru_cache(maxsize=MAX_CACHED_NAMES)
+def resolve_normalized(name):
+    """Returns whether the country is to be ignored, and its code or None."""
+    return (bool(country_converter.should_ignore_country(name)),
+            country_converter.code_from_name(name) or None)
+
+
+def resolve(name, count=1):
+    """
+    Same as resolve_normalized, for a raw name that was seen 'count' times.
+    """
+    global _lookups
+    _lookups += count
+    (ignored, code) = resolve_normalized(normalize(name))
+    if not ignored and code is None:
+        _unresolved[normalize(name)] += count
+    return (ignored, code)
+
+
+def code_from_name(name):
+    """Returns the code of a country, or None for unknown ones."""
+    return resolve(name)[1]
+
+
+def should_ignore_country(name):
+    return resolve_normalized(normalize(name))[0]
+
+
+def codes_from_names(names):
+    """
+    Returns the codes of a list or pandas Series of country names, with None
+    for unknown ones, as an array (or a Series with the same
+    index).
+    """
+    (name_codes, distinct) = pandas.factorize(pandas.Series(names),
+                                              use_na_sentinel=True)
+    counts = numpy.bincount(name_codes[name_codes >= 0],
+                            minlength=len(distinct))
+    table = numpy.array([resolve(n, int(c))[1]
+                         for (n, c) in zip(distinct, counts)] + [None],
+                        dtype=object)
+    # Missing names get the trailing None.
+    codes = table[name_codes]
+    if isinstance(names, pandas.Series):
+        return pandas.Series(codes, index=names.index)
+    return codes
+
+
+def stats():
+    misses = resolve_normalized.cache_info().misses
+    return {
+        "lookups": _lookups,
+        "distinct_names": misses,
+        "cache_hit_rate": round(1 - misses / _lookups, 4) if _lookups
+                          else None,
+        "unresolved": dict(_unresolved.most_common(MAX_REPORTED_UNRESOLVED)),
+    }
+
+
+instrumentation.register_stats("country_resolution", stats)
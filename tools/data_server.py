@@ -0,0 +1,428 @@
+"""
+A local HTTP server for the generated data, for development purposes.
+
+It serves the daily and country slices, the time series and the other data
+files, as well as the about page and its images, using
+precompressed '.br' or '.gz' siblings of a file when the client accepts
+them (and gzipping on the fly otherwise), with ETag and Cache-Control
+headers, conditional requests and byte ranges. ETags are based on the
+content hashes recorded by precompress.py when available.
+
+It also answers 'GET /dailies?from=YYYY-MM-DD&to=YYYY-MM-DD' with a JSON
+array of all daily slices between those dates (both optional and included),
+streamed as the files are read, and
+'GET /tiles?date=YYYY-MM-DD&bbox=west,south,east,north' with the URLs of
+that date's slice tiles (see tiles.py) intersecting the bounding box.
+"""
+
+import asyncio
+import collections
+import email.utils
+import gzip
+import hashlib
+import json
+import os
+import re
+import urllib.parse
+
+from tools import precompress
+from tools import tiles
+
+DEFAULT_PORT = 8002
+
+# The files and directories that can be served, relative to the data root.
+SERVED_FILES = ["about.html", "aggregate.json", "freshness.json",
+                "globals.json", "jhu.json", "location_info.data"]
+SERVED_DIRS = ["c", "d", "img", "t"]
+
+CONTENT_TYPES = {".json": "application/json", ".txt": "text/plain",
+                 ".data": "text/plain", ".html": "text/html",
+                 ".png": "image/png", ".svg": "image/svg+xml"}
+
+# Index files change with every update, slices only when data changes.
+INDEX_CACHE_CONTROL = "no-cache"
+DEFAULT_CACHE_CONTROL = "public, max-age=300"
+
+# Files smaller than this aren't worth compressing on the fly.
+MIN_COMPRESS_SIZE = 1024
+COMPRESSED_CACHE_SIZE = 64
+CHUNK_SIZE = 1 << 16
+
+DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+DATE_FILE = re.compile(r"^(\d{4}-\d{2}-\d{2})\.json$")
+STATUS_TEXT = {200: "OK", 206: "Partial Content", 304: "Not Modified",
+               400: "Bad Request", 404: "Not Found",
+               405: "Method Not Allowed",
+               416: "Range Not Satisfiable"}
+
+
+class DataServer:
+
+    def __init__(self, root):
+        self.root = os.path.realpath(root)
+        # Gzipped content of files without a precompressed sibling, keyed by
+        # path and modification time.
+        self.compressed = collections.OrderedDict()
+        # The precompression manifests, by path, with their modification time.
+        self.manifests = {}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError,
+                        asyncio.LimitOverrunError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                parts = lines[0].split(" ")
+                headers = {}
+                for l in lines[1:]:
+                    if ":" in l:
+                        (name, value) = l.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                if len(parts) != 3:
+                    await self.send_error(writer, 400, False)
+                    break
+                (method, target, version) = parts
+                keep_alive = headers.get("connection", "").lower() != "close" \
+                    and version == "HTTP/1.1"
+                await self.handle_request(writer, method, target, headers,
+                                          keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except OSError:
+            # Covers lost connections, and files that can't be read anymore
+            # mid-response, whose body is then cut short.
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, writer, method, target, headers,
+                             keep_alive):
+        if method not in ["GET", "HEAD"]:
+            await self.send_error(writer, 405, keep_alive)
+            return
+        url = urllib.parse.urlsplit(target)
+        path = urllib.parse.unquote(url.path)
+        if path == "/dailies":
+            query = urllib.parse.parse_qs(url.query)
+            await self.send_dailies(writer, query.get("from", [""])[0],
+                                    query.get("to", [""])[0], method,
+                                    keep_alive)
+            return
+        if path == "/tiles":
+            query = urllib.parse.parse_qs(url.query)
+            await self.send_tiles(writer, query.get("date", [""])[0],
+                                  query.get("bbox", [""])[0], method,
+                                  keep_alive)
+            return
+        file_path = self.resolve(path)
+        if not file_path:
+            await self.send_error(writer, 404, keep_alive)
+            return
+        await self.send_file(writer, file_path, method, headers, keep_alive)
+
+    def resolve(self, path):
+        """Returns the file to serve for a URL path, or None."""
+        relative = os.path.normpath(path.lstrip("/"))
+        if relative.startswith("..") or os.path.isabs(relative):
+            return None
+        top = relative.split(os.sep)[0]
+        if relative not in SERVED_FILES and top not in SERVED_DIRS:
+            return None
+        if relative.endswith(".gz") or relative.endswith(".br"):
+            return None
+        file_path = os.path.realpath(os.path.join(self.root, relative))
+        if not file_path.startswith(self.root + os.sep) or \
+                not os.path.isfile(file_path):
+            return None
+        return file_path
+
+    async def send_file(self, writer, file_path, method, headers,
+                        keep_alive):
+        stat = os.stat(file_path)
+        (content, encoding, extra) = await self.select_representation(
+            file_path, stat, headers.get("accept-encoding", ""))
+        size = len(content) if content is not None else extra.st_size
+        digest = self.content_hash(file_path, stat)
+        if digest is None:
+            digest = hashlib.sha1(
+                (file_path + str(extra.st_mtime_ns) + str(size)).encode()
+            ).hexdigest()
+        etag = '"' + digest[:20] + ("-" + encoding if encoding else "") + '"'
+        last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+
+        response_headers = {
+            "Content-Type": content_type(file_path),
+            "ETag": etag,
+            "Last-Modified": last_modified,
+            "Cache-Control": cache_control(file_path),
+            "Vary": "Accept-Encoding",
+            "Accept-Ranges": "bytes",
+        }
+        if encoding:
+            response_headers["Content-Encoding"] = encoding
+
+        if not_modified(headers, etag, stat.st_mtime):
+            await self.send_head(writer, 304, response_headers, keep_alive)
+            return
+
+        (status, start, end) = (200, 0, size)
+        if "range" in headers and headers.get("if-range", etag) in \
+                [etag, last_modified]:
+            byte_range = parse_range(headers["range"], size)
+            if byte_range is None:
+                response_headers["Content-Range"] = "bytes */" + str(size)
+                await self.send_error(writer, 416, keep_alive,
+                                      response_headers)
+                return
+            if byte_range is not False:
+                (status, (start, end)) = (206, byte_range)
+                response_headers["Content-Range"] = "bytes %d-%d/%d" % (
+                    start, end - 1, size)
+
+        response_headers["Content-Length"] = str(end - start)
+        await self.send_head(writer, status, response_headers, keep_alive)
+        if method == "HEAD":
+            return
+        if content is not None:
+            writer.write(content[start:end])
+            return
+        await self.stream_file(writer, extra.path, start, end)
+
+    def content_hash(self, file_path, stat):
+        """
+        Returns the content hash precompress.py recorded for a file, if the
+        file hasn't changed since.
+        """
+        manifest_path = os.path.join(os.path.dirname(file_path),
+                                     precompress.MANIFEST_FILE_NAME)
+        if not os.path.exists(manifest_path):
+            return None
+        mtime = os.stat(manifest_path).st_mtime_ns
+        if manifest_path not in self.manifests or \
+                self.manifests[manifest_path][0] != mtime:
+            self.manifests[manifest_path] = (
+                mtime, json.loads(read_file(manifest_path)))
+        if stat.st_mtime_ns > mtime:
+            return None
+        return self.manifests[manifest_path][1].get(os.path.basename(file_path))
+
+    async def select_representation(self, file_path, stat, accept_encoding):
+        """
+        Returns (content or None, content encoding, info) for the best
+        representation of a file. When content is None, the file at
+        info.path should be streamed as is; info also has the st_size and
+        st_mtime_ns of what is sent.
+        """
+        accepted = [e.split(";")[0].strip()
+                    for e in accept_encoding.split(",")]
+        for (encoding, suffix) in [("br", ".br"), ("gzip", ".gz")]:
+            sibling = file_path + suffix
+            if encoding in accepted and os.path.exists(sibling) and \
+                    os.path.getmtime(sibling) >= stat.st_mtime:
+                sibling_stat = os.stat(sibling)
+                return (None, encoding,
+                        Representation(sibling, sibling_stat.st_size,
+                                       sibling_stat.st_mtime_ns))
+        plain = Representation(file_path, stat.st_size, stat.st_mtime_ns)
+        if "gzip" not in accepted or stat.st_size < MIN_COMPRESS_SIZE:
+            return (None, "", plain)
+        key = (file_path, stat.st_mtime_ns)
+        if key not in self.compressed:
+            loop = asyncio.get_running_loop()
+            self.compressed[key] = await loop.run_in_executor(
+                None, compress_file, file_path)
+            while len(self.compressed) > COMPRESSED_CACHE_SIZE:
+                self.compressed.popitem(last=False)
+        self.compressed.move_to_end(key)
+        return (self.compressed[key], "gzip", plain)
+
+    async def stream_file(self, writer, path, start, end):
+        loop = asyncio.get_running_loop()
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = await loop.run_in_executor(
+                    None, f.read, min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                writer.write(chunk)
+                await writer.drain()
+            f.close()
+
+    async def send_dailies(self, writer, start_date, end_date, method,
+                           keep_alive):
+        dailies_dir = os.path.join(self.root, "d")
+        dates = []
+        for name in os.listdir(dailies_dir):
+            match = DATE_FILE.match(name)
+            if not match:
+                continue
+            date = match.group(1)
+            if (not start_date or date >= start_date) and \
+                    (not end_date or date <= end_date):
+                dates.append(date)
+        dates.sort()
+        # HTTP/1.0 clients can't decode chunks, and don't keep connections
+        # alive: their body just ends with the connection.
+        headers = {
+            "Content-Type": "application/json",
+            "Cache-Control": INDEX_CACHE_CONTROL,
+        }
+        if keep_alive:
+            headers["Transfer-Encoding"] = "chunked"
+            write = lambda data: write_chunk(writer, data)
+        else:
+            write = writer.write
+        await self.send_head(writer, 200, headers, keep_alive)
+        if method == "HEAD":
+            return
+        loop = asyncio.get_running_loop()
+        write(b"[")
+        separator = b""
+        for date in dates:
+            path = os.path.join(dailies_dir, date + ".json")
+            try:
+                content = await loop.run_in_executor(None, read_file, path)
+            except FileNotFoundError:
+                # Deleted since the directory was listed.
+                continue
+            write(separator + content.strip())
+            separator = b","
+            await writer.drain()
+        write(b"]")
+        if keep_alive:
+            write(b"")
+
+    async def send_tiles(self, writer, date, bbox, method, keep_alive):
+        try:
+            bbox = [float(x) for x in bbox.split(",")]
+        except ValueError:
+            bbox = []
+        if not DATE.match(date) or len(bbox) != 4 or \
+                bbox[1] > bbox[3]:
+            await self.send_error(writer, 400, keep_alive)
+            return
+        dailies_dir = os.path.join(self.root, "d")
+        names = tiles.tiles_covering(dailies_dir, date, bbox)
+        if names is None:
+            await self.send_error(writer, 404, keep_alive)
+            return
+        body = json.dumps({
+            "date": date,
+            "index": "/d/tiles/" + date + "/" + tiles.TILE_INDEX_FILE_NAME,
+            "tiles": ["/d/tiles/" + date + "/" + name + ".json"
+                      for name in names],
+        }).encode()
+        await self.send_head(writer, 200, {
+            "Content-Type": "application/json",
+            "Content-Length": str(len(body)),
+            "Cache-Control": DEFAULT_CACHE_CONTROL,
+        }, keep_alive)
+        if method != "HEAD":
+            writer.write(body)
+
+    async def send_head(self, writer, status, headers, keep_alive):
+        lines = ["HTTP/1.1 " + str(status) + " " + STATUS_TEXT[status]]
+        headers = dict(headers)
+        headers["Date"] = email.utils.formatdate(usegmt=True)
+        headers["Connection"] = "keep-alive" if keep_alive else "close"
+        for name in headers:
+            lines.append(name + ": " + headers[name])
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def send_error(self, writer, status, keep_alive, headers=None):
+        body = json.dumps({"error": STATUS_TEXT[status]}).encode()
+        headers = dict(headers or {})
+        headers["Content-Type"] = "application/json"
+        headers["Content-Length"] = str(len(body))
+        await self.send_head(writer, status, headers, keep_alive)
+        writer.write(body)
+
+
+Representation = collections.namedtuple(
+    "Representation", ["path", "st_size", "st_mtime_ns"])
+
+
+def content_type(path):
+    return CONTENT_TYPES.get(os.path.splitext(path)[1],
+                             "application/octet-stream")
+
+
+def cache_control(path):
+    if os.path.basename(path) in ["index.txt"] + SERVED_FILES:
+        return INDEX_CACHE_CONTROL
+    return DEFAULT_CACHE_CONTROL
+
+
+def not_modified(headers, etag, mtime):
+    if "if-none-match" in headers:
+        tags = [t.strip() for t in headers["if-none-match"].split(",")]
+        return "*" in tags or etag in tags or "W/" + etag in tags
+    if "if-modified-since" in headers:
+        try:
+            since = email.utils.parsedate_to_datetime(
+                headers["if-modified-since"])
+        except (TypeError, ValueError):
+            # A malformed date is treated as if there was none.
+            return False
+        if since is not None:
+            return int(mtime) <= since.timestamp()
+    return False
+
+
+def parse_range(header, size):
+    """
+    Returns the (start, end) bytes of a single range request, None if it
+    can't be satisfied, or False if it should be ignored.
+    """
+    match = re.match(r"^bytes=(\d*)-(\d*)$", header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return False
+    if match.group(1) == "":
+        length = int(match.group(2))
+        if length == 0:
+            return None
+        return (max(0, size - length), size)
+    start = int(match.group(1))
+    end = size if match.group(2) == "" else min(size, int(match.group(2)) + 1)
+    if start >= size or start >= end:
+        return None
+    return (start, end)
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        content = f.read()
+        f.close()
+    return content
+
+
+def compress_file(path):
+    # A fixed modification time keeps the output, and hence ETags, stable.
+    return gzip.compress(read_file(path), mtime=0)
+
+
+def write_chunk(writer, data):
+    writer.write(("%x\r\n" % len(data)).encode() + data + b"\r\n")
+
+
+def serve(root, port=DEFAULT_PORT, host="localhost"):
+    server = DataServer(root)
+
+    async def main():
+        s = await asyncio.start_server(server.handle_connection, host, port)
+        print("Serving '" + server.root + "' on http://" + host + ":" +
+              str(port) + "/")
+        async with s:
+            await s.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
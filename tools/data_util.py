@@ -1,8 +1,11 @@
 import os
+
+import numpy
 import pandas
 
 from tools import calculate_data_freshness_per_country
 from tools import generate_full_data
+from tools import instrumentation
 from tools import jhu_global_data
 
 # The directories (inside app/) where JSON files for country-specific and
@@ -12,23 +15,49 @@ DAILIES_DIR = "app/dailies"
 
 self_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
 
-def build_case_count_table_from_line_list(in_data):
+def build_case_count_table_from_line_list(in_data, sparse=False, dtype="int64"):
     """
     This takes an input data frame where each row represents a single
     case, with a confirmation date and a geo ID, and returns a data
     frame where each row represents a single date, columns are unique
     geo IDs and cells are the sum of corresponding case counts.
+
+    If the data frame has a "count" column, each row instead stands for that
+    many cases, as in a line list that was already partially aggregated.
+
+    Rows are in order of first appearance of each date, columns are sorted.
+    The counting is done in a single pass over the line list. If 'sparse' is
+    True, the cells are stored as a pandas sparse array (this needs scipy),
+    which is much smaller for line lists spanning many locations.
     """
-    unique_dates = in_data.date.unique()
-    unique_geoids = in_data.geoid.unique()
-    unique_geoids.sort()
-    out_data = pandas.DataFrame(columns=unique_geoids, index=unique_dates)
+    date_codes, dates = pandas.factorize(in_data.date)
+    geoid_codes, geoids = pandas.factorize(in_data.geoid, sort=True)
+    # Rows with a missing date or geo ID don't count towards anything.
+    valid = (date_codes >= 0) & (geoid_codes >= 0)
+    date_codes = date_codes[valid]
+    geoid_codes = geoid_codes[valid]
+    weights = None
+    if "count" in in_data.columns:
+        weights = in_data["count"].values[valid]
+    shape = (len(dates), len(geoids))
+
+    if sparse:
+        import scipy.sparse
+        if weights is None:
+            weights = numpy.ones(len(date_codes), dtype=dtype)
+        counts = scipy.sparse.coo_matrix(
+            (weights.astype(dtype), (date_codes, geoid_codes)),
+            shape=shape).tocsr()
+        out_data = pandas.DataFrame.sparse.from_spmatrix(
+            counts, index=dates, columns=geoids)
+    else:
+        counts = numpy.bincount(date_codes * len(geoids) + geoid_codes,
+                                weights=weights,
+                                minlength=shape[0] * shape[1])
+        out_data = pandas.DataFrame(counts.reshape(shape).astype(dtype),
+                                    index=dates, columns=geoids)
 
     out_data.index.name = "date"
-    for date in out_data.index:
-        out_data.loc[date] = in_data[in_data.date == date].geoid.value_counts()
-    out_data = out_data.fillna(0)
-    out_data.reset_index(drop=False)
     return out_data
 
 # Returns whether we were able to get the necessary data
@@ -38,13 +67,17 @@ def retrieve_generable_data(out_dir, should_overwrite=False, quiet=False):
     success = True
     out_path = os.path.join(out_dir, "globals.json")
     if not os.path.exists(out_path) or should_overwrite:
-        success &= scrape_total_count.scrape_total_count(out_path)
+        with instrumentation.stage("scrape_total_count"):
+            success &= scrape_total_count.scrape_total_count(out_path)
     out_path = os.path.join(out_dir, "aggregate.json")
     if not os.path.exists(out_path) or should_overwrite:
-        success &= jhu_global_data.get_aggregate_data(out_path)
+        with instrumentation.stage("get_aggregate_data"):
+            success &= jhu_global_data.get_aggregate_data(out_path)
     out_path = os.path.join(out_dir, "freshness.json")
     if not os.path.exists(out_path) or should_overwrite:
-        success &= calculate_data_freshness_per_country.get_freshness(out_path)
+        with instrumentation.stage("get_freshness"):
+            success &= calculate_data_freshness_per_country.get_freshness(
+                out_path)
 
     return success
 
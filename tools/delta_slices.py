@@ -0,0 +1,103 @@
+"""
+An optional, compact format for daily slices.
+
+Every 'keyframe_interval' dates, a keyframe is written: a regular daily slice
+listing the total for every location seen so far. The slices in between are
+deltas which only list the locations that had new cases on that day:
+
+{"date": "YYYY-MM-DD", "keyframe": "YYYY-MM-DD",
+ "features": [{"properties": {"geoid": "lat|long", "new": int}}, ...]}
+
+Both kinds carry the date of the keyframe they are based on (a keyframe's
+is its own date), so a reader can reconstruct any day from the nearest
+keyframe and the deltas that follow it. Slices written by the new flow
+(case_data_processor.py) give totals that don't include the day's new
+cases, which their keyframes record as "total_includes_new": false.
+"""
+
+import json
+import os
+
+
+def keyframe_for(dates, position, keyframe_interval):
+    """
+    Returns the date of the keyframe the slice at 'position' in the sorted
+    list of 'dates' is based on, or None when not writing keyframes at all.
+    """
+    if not keyframe_interval:
+        return None
+    return dates[position - position % keyframe_interval]
+
+
+def encode(daily_slice, keyframe, total_includes_new=True):
+    """Turns a regular daily slice into a keyframe or a delta slice."""
+    if keyframe is None:
+        return daily_slice
+    if keyframe == daily_slice["date"]:
+        encoded = {"date": daily_slice["date"], "keyframe": keyframe}
+        if not total_includes_new:
+            encoded["total_includes_new"] = False
+        encoded["features"] = daily_slice["features"]
+        return encoded
+    features = []
+    for f in daily_slice["features"]:
+        properties = f["properties"]
+        if properties.get("new", 0) > 0:
+            features.append({"properties": {"geoid": properties["geoid"],
+                                            "new": properties["new"]}})
+    return {"date": daily_slice["date"], "keyframe": keyframe,
+            "features": features}
+
+
+def load_slice(slices_dir, date):
+    with open(os.path.join(slices_dir, date + ".json")) as f:
+        daily_slice = json.loads(f.read())
+        f.close()
+    return daily_slice
+
+
+def list_dates(slices_dir):
+    with open(os.path.join(slices_dir, "index.txt")) as f:
+        names = f.read().split()
+        f.close()
+    return sorted([n.replace(".json", "") for n in names])
+
+
+def read_slice(slices_dir, date):
+    """
+    Returns the daily slice for 'date' in the regular format, with a total
+    for every location seen so far, whichever format it was written in.
+    """
+    daily_slice = load_slice(slices_dir, date)
+    keyframe = daily_slice.get("keyframe", date)
+    if keyframe == date:
+        return {"date": date, "features": daily_slice["features"]}
+
+    keyframe_slice = load_slice(slices_dir, keyframe)
+    total_includes_new = keyframe_slice.get("total_includes_new", True)
+    totals = {}
+    for f in keyframe_slice["features"]:
+        properties = f["properties"]
+        totals[properties["geoid"]] = properties["total"]
+        if not total_includes_new:
+            totals[properties["geoid"]] += properties.get("new", 0)
+    for d in list_dates(slices_dir):
+        if d <= keyframe or d >= date:
+            continue
+        for f in load_slice(slices_dir, d)["features"]:
+            geoid = f["properties"]["geoid"]
+            totals[geoid] = totals.get(geoid, 0) + f["properties"]["new"]
+
+    new_cases = {}
+    for f in daily_slice["features"]:
+        geoid = f["properties"]["geoid"]
+        new_cases[geoid] = f["properties"]["new"]
+        if total_includes_new:
+            totals[geoid] = totals.get(geoid, 0) + new_cases[geoid]
+    features = []
+    for geoid in sorted(set(totals.keys()) | set(new_cases.keys())):
+        properties = {"geoid": geoid, "total": totals.get(geoid, 0)}
+        if geoid in new_cases:
+            properties["new"] = new_cases[geoid]
+        features.append({"properties": properties})
+    return {"date": date, "features": features}
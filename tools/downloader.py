@@ -0,0 +1,241 @@
+"""
+Downloads of the (large) source archives, cached on disk.
+
+Each URL's latest download is kept in the cache directory along with its
+ETag, Last-Modified date and SHA-256. Later fetches of the same URL are
+conditional requests, which don't transfer anything when the source didn't
+change. Interrupted downloads are resumed with range requests (as long as
+the source didn't change in between), and every download is checked against
+its announced length, and its checksum when one is given.
+
+Archives are read straight from the cache by the parsers, which decompress
+them on the fly (see open_archive_member).
+
+Usage: python3 -m tools.downloader URL CACHE_DIR
+prints the path of the cached download.
+"""
+
+import codecs
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import tarfile
+import time
+import urllib.parse
+
+import requests
+
+DEFAULT_ATTEMPTS = 3
+CHUNK_SIZE = 1 << 20
+# Bytes being received when a connection breaks are lost, so they're read
+# in smaller chunks than files.
+RECEIVE_CHUNK_SIZE = 1 << 16
+TIMEOUT_S = 60
+
+Download = collections.namedtuple("Download", ["path", "sha256", "changed"])
+
+
+class DownloadError(Exception):
+    pass
+
+
+class IncompleteDownload(DownloadError):
+    """A download that stopped early, and can be resumed."""
+    pass
+
+
+class Downloads:
+
+    def __init__(self, cache_dir, session=None):
+        self.cache_dir = cache_dir
+        self.session = session or requests.Session()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def paths(self, url):
+        """Returns the data, partial data and metadata paths for 'url'."""
+        key = hashlib.sha1(url.encode()).hexdigest()
+        # Keep the file name, so that readers can tell the format from it.
+        name = os.path.basename(urllib.parse.urlparse(url).path) or "data"
+        data_path = os.path.join(self.cache_dir, key + "-" + name)
+        return (data_path, data_path + ".part",
+                os.path.join(self.cache_dir, key + ".json"))
+
+    def load_metadata(self, url):
+        meta_path = self.paths(url)[2]
+        if not os.path.exists(meta_path):
+            return {}
+        with open(meta_path) as f:
+            meta = json.loads(f.read())
+            f.close()
+        return meta
+
+    def save_metadata(self, url, meta):
+        meta_path = self.paths(url)[2]
+        with open(meta_path + ".tmp", "w") as f:
+            f.write(json.dumps(meta, indent=1, sort_keys=True))
+            f.close()
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def fetch(self, url, sha256=None, quiet=False, attempts=DEFAULT_ATTEMPTS):
+        """
+        Makes sure the cache has the current content of 'url', and returns
+        it as a Download: the path of the cached file, its SHA-256, and
+        whether it changed since the previous fetch. If given, 'sha256' is
+        the checksum the content must have. Downloads that fail midway are
+        resumed up to 'attempts' times in all.
+        """
+        for attempt in range(attempts):
+            try:
+                return self.try_fetch(url, sha256, quiet)
+            except (IncompleteDownload, requests.ConnectionError,
+                    requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as e:
+                if attempt == attempts - 1:
+                    raise DownloadError("Couldn't download '" + url + "': " +
+                                        str(e))
+                if not quiet:
+                    print("Download interrupted (" + str(e) + "), "
+                          "resuming...")
+                time.sleep(attempt)
+
+    def try_fetch(self, url, sha256, quiet):
+        (data_path, part_path, _) = self.paths(url)
+        meta = self.load_metadata(url)
+        # Lengths and ranges are about the bytes we store.
+        headers = {"Accept-Encoding": "identity"}
+        partial = meta.get("partial")
+        offset = os.path.getsize(part_path) \
+            if partial and os.path.exists(part_path) else 0
+        if offset:
+            headers["Range"] = "bytes=" + str(offset) + "-"
+            # Only resume if the source didn't change since.
+            validator = strong_etag(partial.get("etag")) or \
+                partial.get("last_modified")
+            if validator:
+                headers["If-Range"] = validator
+        elif meta.get("sha256") and is_intact(data_path, meta):
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        response = self.session.get(url, headers=headers, stream=True,
+                                    timeout=TIMEOUT_S)
+        if response.status_code == 304:
+            response.close()
+            if sha256 and meta["sha256"] != sha256:
+                raise DownloadError("'" + url + "' doesn't have the expected "
+                                    "checksum")
+            if not quiet:
+                print("'" + url + "' didn't change, using the cached copy.")
+            return Download(data_path, meta["sha256"], False)
+        if offset and response.status_code in [206, 416] and \
+                content_range_start(response) != offset:
+            # The partial download can't be resumed, start over.
+            response.close()
+            os.remove(part_path)
+            del meta["partial"]
+            self.save_metadata(url, meta)
+            raise IncompleteDownload("couldn't resume at byte " + str(offset))
+        if response.status_code == 206 and offset:
+            mode = "ab"
+        elif response.status_code == 200:
+            (mode, offset) = ("wb", 0)
+        else:
+            response.close()
+            raise DownloadError("Got status " + str(response.status_code) +
+                                " for '" + url + "'")
+
+        length = response.headers.get("Content-Length")
+        expected_size = offset + int(length) if length else None
+        meta["partial"] = {"etag": response.headers.get("ETag"),
+                           "last_modified":
+                               response.headers.get("Last-Modified")}
+        self.save_metadata(url, meta)
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(RECEIVE_CHUNK_SIZE):
+                f.write(chunk)
+            f.close()
+        response.close()
+        size = os.path.getsize(part_path)
+        if expected_size is not None and size < expected_size:
+            raise IncompleteDownload("got " + str(size) + " out of " +
+                                     str(expected_size) + " bytes")
+
+        digest = hash_file(part_path)
+        if (expected_size is not None and size != expected_size) or \
+                (sha256 and digest != sha256):
+            os.remove(part_path)
+            del meta["partial"]
+            self.save_metadata(url, meta)
+            raise DownloadError("The download of '" + url + "' is corrupt")
+        changed = digest != meta.get("sha256")
+        os.replace(part_path, data_path)
+        self.save_metadata(url, {
+            "url": url,
+            "etag": meta["partial"]["etag"],
+            "last_modified": meta["partial"]["last_modified"],
+            "sha256": digest,
+            "size": size,
+        })
+        return Download(data_path, digest, changed)
+
+
+def strong_etag(etag):
+    """Returns the ETag if range requests can rely on it, None otherwise."""
+    if etag and not etag.startswith("W/"):
+        return etag
+    return None
+
+
+def content_range_start(response):
+    """Returns where the bytes of a 206 response start, or None."""
+    content_range = response.headers.get("Content-Range", "")
+    try:
+        return int(content_range.split()[1].split("-")[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(block)
+        f.close()
+    return h.hexdigest()
+
+
+def is_intact(path, meta):
+    """Returns whether a cached file still is what was downloaded."""
+    return os.path.exists(path) and \
+        os.path.getsize(path) == meta.get("size") and \
+        hash_file(path) == meta.get("sha256")
+
+
+@contextlib.contextmanager
+def open_archive_member(archive_path, matches):
+    """
+    Opens the first file in a .tar.gz archive whose name 'matches' (a
+    function of the name), as a text stream decompressed on the fly,
+    without extracting anything to disk.
+    """
+    with tarfile.open(archive_path, "r|gz") as tar:
+        for member in tar:
+            if member.isfile() and matches(member.name):
+                # Members of a streamed archive can't tell whether they're
+                # seekable, which io.TextIOWrapper needs to know.
+                yield codecs.getreader("utf-8")(tar.extractfile(member))
+                return
+    raise ValueError("No matching file found in '" + archive_path + "'")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    print(Downloads(sys.argv[2]).fetch(sys.argv[1]).path)
@@ -1,4 +1,24 @@
+import os
+import tempfile
+
 LAT_LNG_DECIMAL_PLACES = 4
 
 def round_lat_long(lat_or_lng):
     return str(round(float(lat_or_lng), LAT_LNG_DECIMAL_PLACES))
+
+def write_atomically(out_path, contents):
+    """
+    Writes 'contents' to a temporary file next to 'out_path' and then moves
+    it in place, so that readers never see a partially written file.
+    """
+    out_dir = os.path.dirname(os.path.abspath(out_path))
+    (fd, tmp_path) = tempfile.mkstemp(dir=out_dir, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(contents)
+            f.close()
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -4,9 +4,13 @@ Pull data from latestdata.csv, and JHU repo for US
 split into daily slices.
 """
 
+import itertools
 import os
 import re
+import shutil
 import sys
+import tarfile
+import tempfile
 
 from io import StringIO
 
@@ -15,11 +19,20 @@ import pandas as pd
 pd.options.mode.chained_assignment = None
 import requests
 
+import country_converter
 import location_info_extractor
 
-from tools import data_util
+from tools import calculate_data_freshness_per_country
+from tools import case_matrix
+from tools import downloader
 from tools import functions
+from tools import geoids
+from tools import instrumentation
+from tools import location_index
+from tools import slice_manifest
 from tools import split
+from tools import stage_cache
+from tools import timeseries
 
 JHU_URL = ("https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/"
            "csse_covid_19_data/csse_covid_19_time_series/"
@@ -28,51 +41,48 @@ JHU_URL = ("https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/"
 LATEST_DATA_URL = ("https://raw.githubusercontent.com/beoutbreakprepared/"
                    "nCoV2019/master/latest_data/latestdata.tar.gz")
 
+# Change these whenever changing how the data is prepared, so that results
+# cached by previous versions aren't used.
+LATEST_DATA_CACHE_VERSION = 3
+JHU_DATA_CACHE_VERSION = 1
+COUNTRY_EXPORT_CACHE_VERSION = 1
+
+LATEST_DATA_COLUMNS = ["city", "province", "country", "date_confirmation",
+                       "date_admission_hospital", "latitude", "longitude"]
+
+# How many rows of the latest data to process at a time when streaming it.
+LATEST_DATA_CHUNK_SIZE = 200000
+
 def generate_geo_ids(df, lat_field_name, lng_field_name, quiet=False):
     if not quiet:
         print("Rounding latitudes and longitudes...")
-    df[lat_field_name] = df[lat_field_name].apply(functions.round_lat_long)
-    df[lng_field_name] = df[lng_field_name].apply(functions.round_lat_long)
+    lat = geoids.parse(df[lat_field_name])
+    lng = geoids.parse(df[lng_field_name])
+    valid = geoids.is_valid(lat, lng)
+    if not valid.all():
+        if not quiet:
+            print("Dropping " + str(int((~valid).sum())) + " rows with "
+                  "missing or invalid coordinates...")
+        df = df[valid].copy()
+        (lat, lng) = (lat[valid], lng[valid])
+    lat = geoids.to_fixed(lat)
+    lng = geoids.to_fixed(lng)
+    df[lat_field_name] = geoids.format_fixed(lat)
+    df[lng_field_name] = geoids.format_fixed(lng)
 
     if not quiet:
         print("Generating 'geo ids'...")
-    df["geoid"] = df[lat_field_name] + "|" + df[lng_field_name]
+    df["geoid"] = geoids.to_strings(geoids.pack(lat, lng))
 
     return df
 
 
-def prepare_latest_data(countries_out_dir, overwrite=True, quiet=False):
-    if not quiet:
-        print("Downloading latest data from '" + LATEST_DATA_URL + "'...")
-    os.system("curl --silent '" + LATEST_DATA_URL + "' > latestdata.tgz")
-    os.system("tar xzf latestdata.tgz")
-    os.remove("latestdata.tgz")
-
-    try:
-        if not quiet:
-            print("Reading the latest data...")
-        df = pd.read_csv(
-            "latestdata.csv",
-            usecols=[
-                "city",
-                "province",
-                "country",
-                "date_confirmation",
-                "date_admission_hospital",
-                "latitude",
-                "longitude"
-            ],
-            dtype=str
-        )
-        os.remove("latestdata.csv")
-
-    except ValueError:
-        print(
-            "I couldn't read data from the source file. Is there something "
-            "wrong with the data at '" + LATEST_DATA_URL + "'?"
-        )
-        sys.exit(1)
-
+def filter_latest_data(df, quiet=False, future_counter=None):
+    """
+    Drops the unusable rows of the latest data, normalizes confirmation dates
+    and adds a "geoid" column. Cases confirmed in the future are dropped too,
+    and counted in 'future_counter' (a list of one number) if given.
+    """
     df["latitude"]  = df.latitude.astype(str)
     df["longitude"] = df.longitude.astype(str)
 
@@ -86,35 +96,289 @@ def prepare_latest_data(countries_out_dir, overwrite=True, quiet=False):
     df.date_confirmation = df.date_confirmation.fillna(df.date_admission_hospital)
     df = df.drop('date_admission_hospital', axis=1)
     df["date_confirmation"] = df.date_confirmation.str.extract("(\d{2}\.\d{2}\.\d{4})")
-    df = df[
-        pd.to_datetime(df.date_confirmation, format="%d.%m.%Y", errors="coerce")
-        < pd.Timestamp.now()
-    ]
+    confirmed = pd.to_datetime(df.date_confirmation, format="%d.%m.%Y",
+                               errors="coerce")
+    if future_counter is not None:
+        future_counter[0] += int((confirmed >= pd.Timestamp.now()).sum())
+    df = df[confirmed < pd.Timestamp.now()]
     df["date_confirmation"] = df["date_confirmation"].apply(split.normalize_date)
 
-    generate_geo_ids(df, "latitude", "longitude", quiet=quiet)
+    df = generate_geo_ids(df, "latitude", "longitude", quiet=quiet)
+
+    return df
+
+
+def common_code_hash():
+    """
+    Returns a hash of the common repo's code that the prepared data depends
+    on, to be part of the cache keys.
+    """
+    return stage_cache.hash_modules(location_info_extractor, country_converter)
+
+
+def country_files_signature(countries_dir):
+    """
+    Returns the names, sizes and modification times of the country files,
+    or None if there are none.
+    """
+    if not os.path.isdir(countries_dir):
+        return None
+    return dict([(f, calculate_data_freshness_per_country.file_signature(
+        os.path.join(countries_dir, f))) for f in
+        calculate_data_freshness_per_country.list_country_files(
+            countries_dir)]) or None
+
+
+def read_file(path):
+    with open(path) as f:
+        contents = f.read()
+        f.close()
+    return contents
+
+
+def write_file(path, contents):
+    with open(path, "w") as f:
+        f.write(contents)
+        f.close()
+
+
+def read_and_filter_latest_data(quiet=False, future_counter=None):
+    """
+    Returns the filtered line list of the downloaded latest data, and the
+    contents of the location info file extracted from it. See
+    filter_latest_data for 'future_counter'.
+    """
+    try:
+        with instrumentation.stage("read_latest_data") as s:
+            if not quiet:
+                print("Reading the latest data...")
+            df = pd.read_csv("latestdata.csv", usecols=LATEST_DATA_COLUMNS,
+                             dtype=str)
+            s.rows_out = len(df)
+
+    except ValueError:
+        exit_with_read_error()
+
+    with instrumentation.stage("filter_latest_data", rows_in=len(df)) as s:
+        df = filter_latest_data(df, quiet=quiet,
+                                future_counter=future_counter)
+        s.rows_out = len(df)
 
     # Extract mappings between lat|long and geographical names, then only keep
     # the geo_id.
-    if not quiet:
-        print("Extracting location info...")
-    location_info_extractor.compile_location_info(df.to_dict("records"),
-                                                  "location_info_world.data",
-                                                  quiet=quiet)
+    with instrumentation.stage("compile_location_info",
+                               rows_in=len(df)) as s:
+        if not quiet:
+            print("Extracting location info...")
+        location_info_extractor.compile_location_info(
+            df.to_dict("records"), "location_info_world.data", quiet=quiet)
     df = df.rename(columns={"date_confirmation": "date"})
     df = df.drop(["city", "province", "latitude", "longitude"], axis=1)
-    if not quiet:
-        print("Slicing by country...")
-    split.slice_by_country_and_export(df, countries_out_dir, overwrite, quiet)
-
-    return data_util.build_case_count_table_from_line_list(df)
-
-
-def prepare_jhu_data(outfile, read_from_file, quiet=False):
-    """Gets JHU US data from the URL and formats it for the client."""
+    return (df, read_file("location_info_world.data"))
+
+
+def iter_latest_data_chunks(archive_path, chunk_size=LATEST_DATA_CHUNK_SIZE):
+    """
+    Yields the rows of the latest data CSV in the 'archive_path' tarball, as
+    data frames of 'chunk_size' rows. The archive is decompressed as a stream,
+    without extracting it.
+    """
+    is_latest_data = lambda name: os.path.basename(name) == "latestdata.csv"
+    with downloader.open_archive_member(archive_path, is_latest_data) as stream:
+        for chunk in pd.read_csv(stream, usecols=LATEST_DATA_COLUMNS,
+                                 dtype=str, chunksize=chunk_size):
+            yield chunk
+
+
+def read_and_count_latest_data(archive_path, quiet=False,
+                               chunk_size=LATEST_DATA_CHUNK_SIZE,
+                               future_counter=None):
+    """
+    Same as read_and_filter_latest_data, but streams the data from the
+    'archive_path' tarball in chunks. Instead of the line list, it returns
+    the number of cases per country, date and geo ID (in a "count" column),
+    so that memory use doesn't grow with the number of cases.
+    """
+    # Case counts by (country, date, geo ID), and the last seen row of each
+    # location, as compile_location_info would use.
+    counts = None
+    locations = None
+    try:
+        with instrumentation.stage("count_latest_data", rows_in=0) as s:
+            if not quiet:
+                print("Reading and filtering the latest data in chunks...")
+            for chunk in iter_latest_data_chunks(archive_path, chunk_size):
+                s.rows_in += len(chunk)
+                chunk = filter_latest_data(chunk, quiet=True,
+                                           future_counter=future_counter)
+                chunk_locations = chunk[["geoid", "country", "province",
+                                         "city"]].drop_duplicates(
+                                             "geoid", keep="last")
+                chunk_counts = chunk.groupby(
+                    ["country", "date_confirmation", "geoid"], sort=False,
+                    dropna=False).size()
+                if counts is None:
+                    (counts, locations) = (chunk_counts, chunk_locations)
+                else:
+                    counts = pd.concat([counts, chunk_counts]).groupby(
+                        level=[0, 1, 2], sort=False, dropna=False).sum()
+                    locations = pd.concat(
+                        [locations, chunk_locations]).drop_duplicates(
+                            "geoid", keep="last")
+                if not quiet:
+                    print(".", end="", flush=True)
+            if not quiet:
+                print("")
+    except (ValueError, tarfile.TarError):
+        exit_with_read_error()
+
+    if counts is None:
+        df = pd.DataFrame({"country": [], "date": [], "geoid": [], "count": []})
+        locations = pd.DataFrame({"geoid": []})
+    else:
+        df = counts.rename("count").reset_index().rename(
+            columns={"date_confirmation": "date"})
+    with instrumentation.stage("compile_location_info",
+                               rows_in=len(locations)):
+        if not quiet:
+            print("Extracting location info...")
+        location_info_extractor.compile_location_info(
+            locations.to_dict("records"), "location_info_world.data",
+            quiet=quiet)
+    return (df, read_file("location_info_world.data"))
+
+
+def exit_with_read_error():
+    print(
+        "I couldn't read data from the source file. Is there something "
+        "wrong with the data at '" + LATEST_DATA_URL + "'?"
+    )
+    sys.exit(1)
+
+
+def prepare_latest_data(countries_out_dir, overwrite=True, quiet=False,
+                        n_workers=None, cache=None, stream=False,
+                        downloads=None):
+    """
+    Downloads and prepares the latest data, slices it by country and returns
+    its new cases as a case_matrix.CaseMatrix. The archive is downloaded
+    through 'downloads', a downloader.Downloads (or into a temporary
+    directory if not given). When given a stage_cache.StageCache, the
+    filtered line list and the case count table are reused from the cache
+    if the downloaded data (and the common repo's code) didn't change, and
+    the country slices aren't written again if they're still as written.
+    With 'stream', the data is read from the downloaded archive in chunks,
+    with flat memory use (see read_and_count_latest_data).
+    """
+    download_dir = None
+    if not downloads:
+        download_dir = tempfile.mkdtemp(prefix="latestdata_")
+        downloads = downloader.Downloads(download_dir)
+    with instrumentation.stage("download_latest_data"):
+        if not quiet:
+            print("Downloading latest data from '" + LATEST_DATA_URL + "'...")
+        try:
+            download = downloads.fetch(LATEST_DATA_URL, quiet=quiet)
+        except downloader.DownloadError as e:
+            print(e)
+            exit_with_read_error()
+
+    source = download.path if stream else "latestdata.csv"
+    today = pd.Timestamp.now().strftime("%Y-%m-%d")
+    key = None
+    cached = None
+    if cache:
+        key = stage_cache.make_key(
+            "latest_data_counts" if stream else "latest_data",
+            LATEST_DATA_CACHE_VERSION, download.sha256, common_code_hash())
+        cached = cache.get(key)
+        # Filtering drops cases confirmed in the future. If it dropped any,
+        # the results are only good for the day they were computed on.
+        if cached and cached[2] not in [None, today]:
+            cached = None
+    if cached:
+        if not quiet:
+            print("The latest data didn't change, using the cached results.")
+        (df, location_info, valid_on) = cached
+        write_file("location_info_world.data", location_info)
+    else:
+        future_counter = [0]
+        if stream:
+            (df, location_info) = read_and_count_latest_data(
+                source, quiet=quiet, future_counter=future_counter)
+        else:
+            with instrumentation.stage("extract_latest_data"):
+                os.system("tar xzf '" + download.path + "'")
+            (df, location_info) = read_and_filter_latest_data(
+                quiet=quiet, future_counter=future_counter)
+        valid_on = today if future_counter[0] else None
+        if key:
+            cache.put(key, (df, location_info, valid_on))
+    if key:
+        # What's derived from the results changes along with them.
+        key = stage_cache.make_key("latest_data_results",
+                                   LATEST_DATA_CACHE_VERSION, key, valid_on)
+    if not stream and os.path.exists(source):
+        os.remove(source)
+    if download_dir:
+        shutil.rmtree(download_dir)
+
+    # The country files are only rewritten if the data changed, or if they
+    # did since they were written.
+    export_key = None
+    if key:
+        export_key = stage_cache.make_key(
+            "country_export", COUNTRY_EXPORT_CACHE_VERSION, key,
+            os.path.abspath(countries_out_dir), overwrite)
+    signature = country_files_signature(countries_out_dir)
+    if export_key and signature and cache.get(export_key) == signature:
+        if not quiet:
+            print("The country slices are up to date.")
+    else:
+        with instrumentation.stage("slice_by_country_and_export",
+                                   rows_in=len(df)):
+            if not quiet:
+                print("Slicing by country...")
+            split.slice_by_country_and_export(df, countries_out_dir,
+                                              overwrite, quiet,
+                                              n_workers=n_workers)
+        if export_key:
+            cache.put(export_key, country_files_signature(countries_out_dir))
+
+    with instrumentation.stage("build_case_count_table",
+                               rows_in=len(df)) as s:
+        build = lambda: case_matrix.from_line_list(df)
+        if key:
+            table = cache.memoize(stage_cache.make_key(
+                "case_count_table", LATEST_DATA_CACHE_VERSION, key), build)
+        else:
+            table = build()
+        s.rows_out = len(table.data)
+    return table
+
+
+def prepare_jhu_data(outfile, read_from_file, quiet=False, cache=None,
+                     downloads=None):
+    """
+    Gets JHU US data from the URL and formats it for the client. When given
+    a stage_cache.StageCache, the result is reused from the cache if the
+    data (and the common repo's code) didn't change. When given a
+    downloader.Downloads, the data is only downloaded again if it changed.
+    """
 
     if read_from_file:
         read_from = read_from_file
+        source_hash = slice_manifest.hash_file(read_from_file)
+    elif downloads:
+        if not quiet:
+            print("Downloading JHU data from '" + JHU_URL + "'...")
+        try:
+            download = downloads.fetch(JHU_URL, quiet=quiet)
+        except downloader.DownloadError as e:
+            print("Could not get JHU data, aborting. " + str(e))
+            sys.exit(1)
+        read_from = download.path
+        source_hash = download.sha256
     else:
         # Get JHU data
         if not quiet:
@@ -125,12 +389,38 @@ def prepare_jhu_data(outfile, read_from_file, quiet=False):
                   "Status code " + str(req.status_code))
             sys.exit(1)
         read_from = StringIO(req.text)
+        source_hash = stage_cache.hash_bytes(req.text)
 
-    df = pd.read_csv(read_from)
+    key = None
+    cached = None
+    if cache:
+        key = stage_cache.make_key("jhu_data", JHU_DATA_CACHE_VERSION,
+                                   source_hash, common_code_hash())
+        cached = cache.get(key)
 
+    if outfile or not cached:
+        df = pd.read_csv(read_from)
     if outfile:
         df.to_csv(outfile, index=False)
 
+    if cached:
+        if not quiet:
+            print("The JHU data didn't change, using the cached results.")
+        (df, location_info) = cached
+        write_file("location_info_us.data", location_info)
+        return df
+    df = format_jhu_data(df, quiet=quiet)
+    if key:
+        cache.put(key, (df, read_file("location_info_us.data")))
+    return df
+
+
+def format_jhu_data(df, quiet=False):
+    """
+    Turns JHU's cumulative counts per county into a frame of new cases, with
+    a row per date and a column per geo ID. Also writes the location info
+    of the counties to 'location_info_us.data'.
+    """
     roundto = functions.LAT_LNG_DECIMAL_PLACES
     df["Lat"] = df.Lat.round(roundto)
     df["Long_"] = df.Long_.round(roundto)
@@ -140,7 +430,7 @@ def prepare_jhu_data(outfile, read_from_file, quiet=False):
     df = df[df.Admin2 != "Unassigned"]
     df = df[~((df.Lat == 0) & (df.Long_ == 0))]
 
-    generate_geo_ids(df, "Lat", "Long_", quiet=quiet)
+    df = generate_geo_ids(df, "Lat", "Long_", quiet=quiet)
 
     location_info_extractor.compile_location_info(df.to_dict("records"),
         "location_info_us.data",
@@ -178,31 +468,70 @@ def prepare_jhu_data(outfile, read_from_file, quiet=False):
 
 
 def generate_data(dailies_out_dir, countries_out_dir, jhu=False, input_jhu="",
-                  export_full_data=False, overwrite=False, quiet=False):
-
-    latest = prepare_latest_data(countries_out_dir, overwrite, quiet=quiet)
-    jhu = prepare_jhu_data(jhu, input_jhu, quiet=quiet)
-
-    full = latest.merge(jhu, on="date", how="outer")
-    full.fillna(0, inplace=True)
-    full = full.set_index("date")
-    for c in full.columns:
-        if c == "date":
-            continue
-
-        full[c] = full[c].astype(int)
+                  export_full_data=False, overwrite=False, quiet=False,
+                  incremental=True, n_workers=None, matrix_out_dir=None,
+                  cache_dir=None, stream_latest_data=False, tile_size=0,
+                  timeseries_out_dir=None):
+
+    # Stage outputs, and downloads, are cached in 'cache_dir', if given.
+    cache = stage_cache.open_cache(cache_dir)
+    downloads = None
+    if cache_dir:
+        downloads = downloader.Downloads(os.path.join(cache_dir, "downloads"))
+    with instrumentation.stage("prepare_latest_data") as s:
+        latest = prepare_latest_data(countries_out_dir, overwrite, quiet=quiet,
+                                     n_workers=n_workers, cache=cache,
+                                     stream=stream_latest_data,
+                                     downloads=downloads)
+        s.rows_out = len(latest.data)
+    with instrumentation.stage("prepare_jhu_data") as s:
+        jhu = prepare_jhu_data(jhu, input_jhu, quiet=quiet, cache=cache,
+                               downloads=downloads)
+        s.rows_out = len(jhu)
+
+    # Both tables are merged, and then sliced, as sparse case matrices: most
+    # locations only have cases on a few dates.
+    with instrumentation.stage("merge_case_counts",
+                               rows_in=len(latest.data) + len(jhu)) as s:
+        jhu_matrix = case_matrix.from_frame(jhu.set_index("date"))
+        full = case_matrix.merge(latest, jhu_matrix)
+        s.rows_out = len(full.data)
 
     if export_full_data:
-        full.to_csv(export_full_data)
-
-    if not quiet:
-        print("Slicing by date...")
-    split.slice_by_day_and_export(full, dailies_out_dir, overwrite=overwrite,
-                                  quiet=quiet)
-
-    # Concatenate location info for the US and elsewhere
-    os.system("rm -f location_info.data")
-    os.system("cat location_info_world.data location_info_us.data > "
-              "location_info.data")
-    os.remove("location_info_world.data")
-    os.remove("location_info_us.data")
+        case_matrix.query(full).to_csv(export_full_data)
+
+    if matrix_out_dir:
+        with instrumentation.stage("save_case_matrix",
+                                   rows_in=len(full.data)):
+            if not quiet:
+                print("Storing the case matrix in '" + matrix_out_dir + "'...")
+            case_matrix.save(full, matrix_out_dir)
+    if timeseries_out_dir:
+        with instrumentation.stage("export_timeseries",
+                                   rows_in=len(full.data)) as s:
+            s.rows_out = timeseries.export(full, timeseries_out_dir,
+                                           quiet=quiet)
+
+    with instrumentation.stage("slice_by_day_and_export",
+                               rows_in=len(full.data)):
+        if not quiet:
+            print("Slicing by date...")
+        sources = {"latestdata": case_matrix.content_hash(latest),
+                   "jhu": slice_manifest.hash_frame(jhu)}
+        split.slice_by_day_and_export(full, dailies_out_dir,
+                                      overwrite=overwrite, quiet=quiet,
+                                      incremental=incremental, sources=sources,
+                                      tile_size=tile_size)
+
+    # Combine location info for the US and elsewhere. Together, they list
+    # all the current locations, so the index is rebuilt from them.
+    with instrumentation.stage("merge_location_info") as s:
+        index = location_index.LocationIndex(
+            location_index.index_path_for("location_info.data"),
+            bootstrap_from="location_info.data")
+        paths = ["location_info_world.data", "location_info_us.data"]
+        s.rows_out = index.rebuild(itertools.chain(
+            *[location_index.read_entries(path) for path in paths]))
+        for path in paths:
+            os.remove(path)
+        index.export("location_info.data")
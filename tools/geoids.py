@@ -0,0 +1,110 @@
+"""
+Vectorized geo ID generation.
+
+Latitudes and longitudes are rounded in bulk to fixed-point integers (with
+functions.LAT_LNG_DECIMAL_PLACES decimals), and a location is represented
+by a single int64 key packing both. Keys are only turned into the usual
+"lat|lng" strings at the end, formatting each distinct location once. The
+strings are the same as functions.round_lat_long would give, except that
+coordinates rounding to -0.0 are written as "0.0". Coordinates that are
+missing or not finite have no geo ID, and are to be dropped beforehand (see
+is_valid).
+"""
+
+import numpy
+import pandas
+
+from tools import functions
+
+SCALE = 10 ** functions.LAT_LNG_DECIMAL_PLACES
+
+# Offsets making fixed-point latitudes and longitudes non-negative, so that
+# they can be packed in the high and low halves of an int64. They're much
+# wider than valid coordinates need, since the sources have some that are out
+# of range (e.g. longitudes below -180), which are kept as they are.
+LAT_OFFSET = 1 << 30
+LNG_OFFSET = 1 << 31
+
+
+def parse(values):
+    """
+    Returns an array-like of latitudes or longitudes (numbers or numeric
+    strings) as floats, with NaN for missing values.
+    """
+    values = pandas.Series(values)
+    if not pandas.api.types.is_numeric_dtype(values):
+        # Parse each distinct string once, with float() since pandas' own
+        # parser isn't always exact to the last bit. Missing values get NaN.
+        (codes, uniques) = pandas.factorize(values)
+        parsed = numpy.array([float(u) for u in uniques] + [numpy.nan])
+        values = parsed[codes]
+    return numpy.asarray(values, dtype=numpy.float64)
+
+
+def is_valid(lat, lng):
+    """
+    Returns which of the parsed coordinates can be given a geo ID: those
+    that are finite and fit in a packed key.
+    """
+    with numpy.errstate(invalid="ignore"):
+        return numpy.isfinite(lat) & numpy.isfinite(lng) & \
+            (numpy.abs(lat) * SCALE < LAT_OFFSET - 1) & \
+            (numpy.abs(lng) * SCALE < LNG_OFFSET - 1)
+
+
+def to_fixed(values):
+    """
+    Rounds an array-like of finite latitudes or longitudes (numbers or
+    numeric strings) to fixed-point integers, with the same half-even
+    rounding as Python's round().
+    """
+    values = parse(values)
+    if not numpy.isfinite(values).all():
+        raise ValueError("Coordinates must be finite to be rounded")
+    scaled = values * SCALE
+    fixed = numpy.rint(scaled)
+    # Scaling isn't exact, so values very close to a tie might be rounded the
+    # wrong way. Those are rare enough to be rounded one by one.
+    near_tie = numpy.abs(numpy.abs(scaled - numpy.floor(scaled)) - 0.5) < 1e-6
+    for i in numpy.flatnonzero(near_tie):
+        fixed[i] = round(round(float(values[i]),
+                               functions.LAT_LNG_DECIMAL_PLACES) * SCALE)
+    return fixed.astype(numpy.int64)
+
+
+def pack(lat_fixed, lng_fixed):
+    lat_fixed = numpy.asarray(lat_fixed, dtype=numpy.int64)
+    lng_fixed = numpy.asarray(lng_fixed, dtype=numpy.int64)
+    if (numpy.abs(lat_fixed) >= LAT_OFFSET).any() or \
+            (numpy.abs(lng_fixed) >= LNG_OFFSET).any():
+        raise ValueError("Coordinates out of range for a geo ID")
+    return ((lat_fixed.astype(numpy.int64) + LAT_OFFSET) << 32) | \
+        (lng_fixed.astype(numpy.int64) + LNG_OFFSET)
+
+
+def unpack(keys):
+    keys = numpy.asarray(keys, dtype=numpy.int64)
+    return ((keys >> 32) - LAT_OFFSET, (keys & 0xFFFFFFFF) - LNG_OFFSET)
+
+
+def format_fixed(fixed):
+    """
+    Returns the string form of fixed-point coordinates, formatting each
+    distinct value only once.
+    """
+    (codes, uniques) = pandas.factorize(numpy.asarray(fixed))
+    strings = numpy.array([str(int(u) / SCALE) for u in uniques], dtype=object)
+    return strings[codes]
+
+
+def to_strings(keys):
+    """Returns the "lat|lng" strings for an array of packed keys."""
+    (codes, uniques) = pandas.factorize(numpy.asarray(keys))
+    (lat, lng) = unpack(uniques)
+    strings = numpy.array([str(int(a) / SCALE) + "|" + str(int(b) / SCALE)
+                           for (a, b) in zip(lat, lng)], dtype=object)
+    return strings[codes]
+
+
+def make_keys(lat, lng):
+    return pack(to_fixed(lat), to_fixed(lng))
@@ -0,0 +1,238 @@
+"""
+Lightweight instrumentation of the pipeline's stages.
+
+A stage is a 'with stage("name") as s:' block. It records wall and CPU time
+(of this process and of the worker processes it waited for), peak memory,
+bytes written, and the rows in and out that the block reports by setting
+'s.rows_in' and 's.rows_out'. Stages can be nested.
+
+Between start_run() and end_run(), finished stages are collected into a run
+report, which end_run() writes as JSON and summarizes. end_run() is meant
+to be called from a 'finally' clause, so that failed runs are reported too
+(with "failed" set). One stage of the run
+can also be profiled with cProfile, its stats going to a '.prof' file.
+Modules can also register functions returning extra figures of their own
+with register_stats(), which the report includes under "stats".
+Outside of a run, stages are measured but not reported anywhere.
+
+Memory and I/O figures come from /proc, so they're only available on Linux.
+"""
+
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+
+# Set these environment variables to override where the run report is
+# written, and to name a stage to profile.
+REPORT_PATH_VARIABLE = "RUN_REPORT"
+PROFILE_STAGE_VARIABLE = "PROFILE_STAGE"
+
+# The run in progress, if any.
+_run = None
+# The stages in progress, innermost last.
+_active = []
+# Functions returning extra figures for the run report, by name.
+_stats_providers = {}
+
+
+class Stage:
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.parent = _active[-1].name if _active else None
+        self.depth = len(_active)
+        self.peak_rss = 0
+        self.profiler = None
+
+    def __enter__(self):
+        if _active:
+            # Resetting the peak below would lose the enclosing stage's.
+            _active[-1].note_peak_rss()
+        reset_peak_rss()
+        _active.append(self)
+        if _run:
+            # Keep the report in the order stages started in.
+            self.position = len(_run["stages"])
+            _run["stages"].append(None)
+            if _run["profile_stage"] == self.name:
+                self.profiler = cProfile.Profile()
+        self.start_wall = time.time()
+        self.start_perf = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.start_workers = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.start_written = bytes_written()
+        if self.profiler:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profiler:
+            self.profiler.disable()
+        wall = time.perf_counter() - self.start_perf
+        cpu = time.process_time() - self.start_cpu
+        workers = resource.getrusage(resource.RUSAGE_CHILDREN)
+        written = bytes_written()
+        self.note_peak_rss()
+        _active.pop()
+        if _active:
+            _active[-1].peak_rss = max(_active[-1].peak_rss, self.peak_rss)
+
+        record = {
+            "stage": self.name,
+            "parent": self.parent,
+            "depth": self.depth,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S",
+                                     time.localtime(self.start_wall)),
+            "wall_s": round(wall, 3),
+            "cpu_s": round(cpu, 3),
+            "worker_cpu_s": round(
+                workers.ru_utime + workers.ru_stime -
+                self.start_workers.ru_utime - self.start_workers.ru_stime, 3),
+            "peak_rss_mb": round(self.peak_rss / (1024.0 * 1024), 1),
+            "peak_worker_rss_mb": None,
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "rows_per_s": None,
+            "bytes_written": None,
+            "failed": exc_type is not None,
+        }
+        # This is a high-water mark over all workers so far, so it only tells
+        # us something about this stage if it went up.
+        if workers.ru_maxrss > self.start_workers.ru_maxrss:
+            record["peak_worker_rss_mb"] = round(workers.ru_maxrss / 1024.0, 1)
+        if self.rows_in is not None and wall > 0:
+            record["rows_per_s"] = round(self.rows_in / wall, 1)
+        if written is not None and self.start_written is not None:
+            record["bytes_written"] = written - self.start_written
+        if self.profiler:
+            record["profile"] = (_run["report_path"] or _run["name"]) + \
+                "." + self.name + ".prof"
+            self.profiler.dump_stats(record["profile"])
+        if _run and hasattr(self, "position"):
+            _run["stages"][self.position] = record
+        return False
+
+    def note_peak_rss(self):
+        self.peak_rss = max(self.peak_rss, peak_rss())
+
+
+def stage(name, rows_in=None):
+    return Stage(name, rows_in)
+
+
+def register_stats(name, provider):
+    """
+    Has the run report include 'provider()', a JSON-serializable value,
+    under "stats" -> 'name'.
+    """
+    _stats_providers[name] = provider
+
+
+def read_proc_file(name):
+    """Returns a dictionary of the 'key: value' lines of a /proc/self file."""
+    try:
+        with open(os.path.join("/proc/self", name)) as f:
+            lines = f.read().splitlines()
+            f.close()
+    except OSError:
+        return {}
+    return dict([[p.strip() for p in l.split(":", 1)] for l in lines
+                 if ":" in l])
+
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+            f.close()
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """Returns the peak resident memory in bytes since the last reset."""
+    hwm = read_proc_file("status").get("VmHWM")
+    if hwm:
+        return int(hwm.split()[0]) * 1024
+    # No /proc: fall back to the peak over the process's whole life.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def bytes_written():
+    """
+    Returns how many bytes this process and its finished workers have
+    written so far, or None if that isn't known.
+    """
+    wchar = read_proc_file("io").get("wchar")
+    return int(wchar) if wchar else None
+
+
+def start_run(name, report_path=None, profile_stage=None):
+    """
+    Starts collecting stages into a report for the run 'name', to be written
+    at 'report_path' (or the path in the RUN_REPORT environment variable).
+    """
+    global _run
+    _run = {
+        "name": name,
+        "report_path": os.environ.get(REPORT_PATH_VARIABLE, report_path),
+        "profile_stage": os.environ.get(PROFILE_STAGE_VARIABLE, profile_stage),
+        "started": time.time(),
+        "stages": [],
+    }
+
+
+def end_run(quiet=False):
+    """
+    Writes the report of the current run, and returns it. The run failed if
+    an exception is being handled, or if any stage failed.
+    """
+    global _run
+    if not _run:
+        return None
+    stages = [s for s in _run["stages"] if s]
+    # Peaks are reset for each stage, so the process' own one can miss some.
+    peak = max([s["peak_rss_mb"] for s in stages] + [
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0])
+    report = {
+        "run": _run["name"],
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S",
+                                 time.localtime(_run["started"])),
+        "wall_s": round(time.time() - _run["started"], 3),
+        "peak_rss_mb": round(peak, 1),
+        "failed": sys.exc_info()[0] is not None or
+                  any([s["failed"] for s in stages]),
+        "stages": stages,
+        "stats": dict([(name, provider()) for (name, provider) in
+                       sorted(_stats_providers.items())]),
+    }
+    if _run["report_path"]:
+        with open(_run["report_path"], "w") as f:
+            f.write(json.dumps(report, indent=1) + "\n")
+            f.close()
+    if not quiet:
+        print_summary(report)
+        if _run["report_path"]:
+            print("Run report written to '" + _run["report_path"] + "'.")
+    _run = None
+    return report
+
+
+def print_summary(report):
+    print("Stage".ljust(40) + "Wall (s)".rjust(10) + "Peak (MB)".rjust(11) +
+          "Rows in".rjust(12))
+    for s in report["stages"]:
+        indent = "  " * s["depth"]
+        print((indent + s["stage"]).ljust(40) + str(s["wall_s"]).rjust(10) +
+              str(s["peak_rss_mb"]).rjust(11) +
+              ("" if s["rows_in"] is None else str(s["rows_in"])).rjust(12))
+    print("Total".ljust(40) + str(report["wall_s"]).rjust(10) +
+          str(report["peak_rss_mb"]).rjust(11) +
+          (" (failed)" if report.get("failed") else ""))
+    for (name, figures) in report.get("stats", {}).items():
+        print(name + ": " + json.dumps(figures, sort_keys=True))
@@ -1,60 +1,153 @@
 #!/usr/bin/env python3
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import csv
+import os
 import sys
 import json
 
-import country_converter
 import requests
+from requests.adapters import HTTPAdapter, Retry
 
+from tools import country_resolution
 from tools import data_util
+from tools import functions
+from tools import precompress
 
-def get_aggregate_data(outfile):
+DAILY_REPORTS_URL = ("https://raw.githubusercontent.com/CSSEGISandData/"
+                     "COVID-19/master/csse_covid_19_data/"
+                     "csse_covid_19_daily_reports/")
+
+# How many daily reports are fetched at the same time.
+DEFAULT_CONCURRENCY = 8
+
+# How many of the most recent days are fetched again in incremental mode,
+# since their reports can still be revised.
+REVISION_DAYS = 3
+
+def make_session(concurrency=DEFAULT_CONCURRENCY, retries=3, backoff=0.5):
+    """
+    Returns a session that keeps up to 'concurrency' connections open and
+    retries failed requests with an exponential backoff. A '404' isn't
+    retried, since that's how we find out that a report doesn't exist.
+    """
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=[429, 500, 502, 503, 504],
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency,
+                          max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def get_aggregate_data(outfile, concurrency=DEFAULT_CONCURRENCY,
+                       base_url=DAILY_REPORTS_URL, incremental=True,
+                       revision_days=REVISION_DAYS):
+    """
+    Writes the aggregate data to 'outfile'. When 'incremental' is set and
+    'outfile' already exists, only the days missing from it and the last
+    'revision_days' days (whose reports can still be revised) are fetched.
+    """
     print("Fetching aggregate data...")
     max_days = 365
-    one_successful_fetch = False
-    data = {}
+    now = datetime.now()
+    dates = [now - timedelta(days=days_ago)
+             for days_ago in range(1, max_days + 2)]
+    session = make_session(concurrency)
+
+    existing = {}
+    if incremental and os.path.exists(outfile):
+        with open(outfile) as f:
+            existing = json.loads(f.read())
+            f.close()
+    if existing:
+        data = fetch_missing_days(existing, dates, session, base_url,
+                                  concurrency, revision_days)
+    else:
+        data = fetch_all_days(dates, session, base_url, concurrency)
+    session.close()
+
+    functions.write_atomically(outfile, json.dumps(data, sort_keys=True))
+    precompress.precompress([outfile])
+    return True
 
+def fetch_all_days(dates, session, base_url, concurrency):
+    data = {}
+    one_successful_fetch = False
     # Keep fetching data while there's more. Sometimes, depending on the time
     # of day, the data for the previous day isn't available yet. We don't give
     # up until we've had at least one successful fetch and then an unsuccessful
-    # fetch.
-    days_ago = 1
-    now = datetime.now()
-    while days_ago <= max_days + 1:
-        date = now - timedelta(days=days_ago)
-        current_data = fetch_one_day(date.strftime('%m-%d-%Y'))
-        if not len(current_data):
-            if one_successful_fetch:
-                # This is the end, my only friend
-                print("We are fetching data into the past until we get a '404',"
-                      "indicating that this is as far back as the data goes. "
-                      "A '404' error is thus expected towards the end of this "
-                      "fetching process.")
-                break
-
-        one_successful_fetch = True
-        data[date.strftime("%Y-%m-%d")] = current_data
-        days_ago += 1
-
-    with open(outfile, 'w') as f:
-        json.dump(data, f, sort_keys=True)
-        f.close()
-    return True
+    # fetch. Days are fetched 'concurrency' at a time, most recent first.
+    with ThreadPoolExecutor(concurrency) as executor:
+        for start in range(0, len(dates), concurrency):
+            batch = dates[start:start + concurrency]
+            results = executor.map(
+                lambda d: fetch_one_day(d.strftime('%m-%d-%Y'), session,
+                                        base_url), batch)
+            for (date, current_data) in zip(batch, results):
+                if not len(current_data):
+                    if one_successful_fetch:
+                        # This is the end, my only friend
+                        print("We are fetching data into the past until we "
+                              "get a '404', indicating that this is as far "
+                              "back as the data goes. A '404' error is thus "
+                              "expected towards the end of this fetching "
+                              "process.")
+                        return data
+                    continue
+                one_successful_fetch = True
+                data[date.strftime("%Y-%m-%d")] = current_data
+    return data
+
+def fetch_missing_days(existing, dates, session, base_url, concurrency,
+                       revision_days):
+    """
+    Returns 'existing' merged with freshly fetched data for the days that are
+    missing or empty in it, or recent enough to have been revised. Nothing
+    older than the oldest day we already have is fetched, since that's as far
+    back as the data goes.
+    """
+    oldest = min(existing.keys())
+    keys = [d.strftime("%Y-%m-%d") for d in dates]
+    to_fetch = []
+    for i in range(len(dates)):
+        if keys[i] < oldest:
+            continue
+        if i < revision_days or not existing.get(keys[i]):
+            to_fetch.append(dates[i])
+    print("Fetching " + str(len(to_fetch)) + " missing or recent days...")
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = executor.map(
+            lambda d: fetch_one_day(d.strftime('%m-%d-%Y'), session,
+                                    base_url), to_fetch)
+        data = dict(existing)
+        for (date, current_data) in zip(to_fetch, results):
+            # A report that isn't available (yet) doesn't erase what we had.
+            if len(current_data):
+                data[date.strftime("%Y-%m-%d")] = current_data
+    print()
+
+    # Keep the same window of days as a full fetch would, without the empty
+    # days that older versions of this script used to write.
+    return {k: data[k] for k in data if k >= keys[-1] and data[k]}
 
-# Returns whether the operation was successful.
-def fetch_one_day(date):
-    url_base = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_daily_reports/{}.csv'
-    url = url_base.format(date)
+# Returns the features for the given day, or an empty list if the operation
+# wasn't successful.
+def fetch_one_day(date, session=None, base_url=DAILY_REPORTS_URL):
+    url = base_url + date + ".csv"
     print(date, end="  ", flush=True)
 
-    req = requests.get(url)
+    req = (session or requests).get(url)
     if req.status_code != 200:
         print("Got status " + str(req.status_code) + " for '" + url + "'")
         return []
+    return parse_daily_report(req.text)
 
-    reader = csv.DictReader(req.text.split("\n"), delimiter=',', quotechar='"')
+def parse_daily_report(text):
+    reader = csv.DictReader(text.split("\n"), delimiter=',', quotechar='"')
     features = []
 
     # A dictionary with country codes as keys, and values are arrays of
@@ -65,9 +158,9 @@ def fetch_one_day(date):
         if key not in row:
             key = "Country/Region"
         country_name = row[key].replace('"', '').strip()
-        if country_converter.should_ignore_country(country_name):
+        (ignored, code) = country_resolution.resolve(country_name)
+        if ignored:
             continue
-        code = country_converter.code_from_name(country_name)
         if not code:
             print("Note: I couldn't find country '" + country_name + "'")
             continue
@@ -0,0 +1,259 @@
+"""
+An on-disk index of location info, i.e. 'geoid:info' lines such as
+"48.8567|2.3423:Paris|Ile-de-France|FR".
+
+The index is a text file of such lines sorted by (latitude, longitude), so a
+geo ID can be looked up with a binary search over file offsets without
+reading the whole file. New or more precise entries are appended to a small
+journal next to it, and only folded into the sorted file when compacting.
+The usual 'location_info.data' file is produced from the index as an export.
+
+Merging never removes entries, so locations that aren't in the sources
+anymore stay. When the sources are the complete list of locations, the index
+is rebuilt from them instead, which drops those.
+"""
+
+import os
+import re
+import shutil
+
+# Concatenating files without a trailing newline used to glue two lines
+# together, as in "...|Wyoming|US43.8426|143.7197:Kitami|Hokkaido|JP".
+GLUED_LINES = re.compile(r"(?<=\|[A-Z]{2})(?=-?\d+\.\d+\|-?\d+\.\d+:)")
+
+INDEX_SUFFIX = ".index"
+JOURNAL_SUFFIX = ".journal"
+
+
+def index_path_for(export_path):
+    """Returns where the index behind a 'geoid:info' export file lives."""
+    return os.path.splitext(export_path)[0] + INDEX_SUFFIX
+
+
+def read_entries(path):
+    """Yields the (geo ID, info) pairs of a 'geoid:info' text file."""
+    with open(path, encoding="utf-8") as f:
+        for l in f:
+            for part in GLUED_LINES.split(l):
+                entry = parse_line(part)
+                if entry:
+                    yield entry
+        f.close()
+
+
+def parse_line(line):
+    """Returns a (geo ID, info) pair, or None for a malformed line."""
+    line = line.strip()
+    if ":" not in line:
+        return None
+    (geoid, info) = line.split(":", 1)
+    try:
+        sort_key(geoid)
+    except ValueError:
+        return None
+    return (geoid, info)
+
+
+def sort_key(geoid):
+    (lat, lng) = geoid.split("|")
+    return (float(lat), float(lng))
+
+
+def is_more_precise(info, existing):
+    # We assume a longer info string means more precision.
+    return existing is None or len(info) > len(existing)
+
+
+class LocationIndex:
+
+    def __init__(self, path, bootstrap_from=None, normalize=None):
+        """
+        Opens the index at 'path'. If it doesn't exist yet, or if the
+        'geoid:info' file 'bootstrap_from' was changed since it was last
+        exported (e.g. by a sanitizing script), it is built from that file.
+        If given, 'normalize' is a function of a geo ID returning its
+        canonical form, which is applied to the entries it's built from and
+        to merged ones, so that geo IDs written with a different rounding
+        end up as the same location.
+        """
+        self.path = path
+        self.normalize = normalize
+        self.journal_path = path + JOURNAL_SUFFIX
+        has_source = bootstrap_from and os.path.exists(bootstrap_from)
+        if not os.path.exists(path) or (has_source and os.path.getmtime(
+                bootstrap_from) > os.path.getmtime(path)):
+            entries = {}
+            if has_source:
+                for entry in self.normalized(read_entries(bootstrap_from)):
+                    add_if_more_precise(entries, entry)
+            write_sorted(path, entries)
+        # Pending entries, by sort key, as (geo ID, info) pairs.
+        self.pending = {}
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding="utf-8") as f:
+                for l in f:
+                    entry = parse_line(l)
+                    if entry:
+                        self.pending[sort_key(entry[0])] = entry
+                f.close()
+
+    def normalized(self, entries):
+        if not self.normalize:
+            return entries
+        return ((self.normalize(geoid), info) for (geoid, info) in entries)
+
+    def lookup(self, geoid):
+        """Returns the info for 'geoid', or None if it's unknown."""
+        key = sort_key(geoid)
+        if key in self.pending:
+            return self.pending[key][1]
+        with open(self.path, "rb") as f:
+            entry = find_sorted(f, os.path.getsize(self.path), key)
+            f.close()
+        return entry[1] if entry else None
+
+    def merge(self, entries):
+        """
+        Records the (geo ID, info) pairs that are new or more precise than
+        what the index has, and returns how many were.
+        """
+        applied = []
+        with open(self.path, "rb") as f:
+            size = os.path.getsize(self.path)
+            for (geoid, info) in self.normalized(entries):
+                key = sort_key(geoid)
+                if key in self.pending:
+                    existing = self.pending[key][1]
+                else:
+                    existing = find_sorted(f, size, key)
+                    existing = existing[1] if existing else None
+                if is_more_precise(info, existing):
+                    self.pending[key] = (geoid, info)
+                    applied.append(geoid + ":" + info)
+            f.close()
+        if applied:
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write("\n".join(applied) + "\n")
+                f.close()
+        return len(applied)
+
+    def rebuild(self, entries):
+        """
+        Replaces the whole index with the most precise of the (geo ID, info)
+        pairs for each location, dropping the locations that aren't in them.
+        The sorted file is only rewritten if that changes anything. Returns
+        how many locations were added, changed or removed.
+        """
+        rebuilt = {}
+        for entry in entries:
+            add_if_more_precise(rebuilt, entry)
+        current = {}
+        for entry in read_entries(self.path):
+            current[sort_key(entry[0])] = entry
+        current.update(self.pending)
+        changed = len([k for k in set(rebuilt) | set(current)
+                       if rebuilt.get(k) != current.get(k)])
+        if changed:
+            tmp_path = self.path + ".tmp"
+            write_sorted(tmp_path, rebuilt)
+            os.replace(tmp_path, self.path)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.pending = {}
+        return changed
+
+    def compact(self):
+        """Folds the journal into the sorted file, in a single pass."""
+        if not self.pending:
+            return
+        pending = sorted(self.pending.items())
+        tmp_path = self.path + ".tmp"
+        i = 0
+        with open(self.path, encoding="utf-8") as src, \
+                open(tmp_path, "w", encoding="utf-8") as out:
+            for l in src:
+                entry = parse_line(l)
+                if not entry:
+                    continue
+                key = sort_key(entry[0])
+                while i < len(pending) and pending[i][0] < key:
+                    out.write(":".join(pending[i][1]) + "\n")
+                    i += 1
+                if i < len(pending) and pending[i][0] == key:
+                    out.write(":".join(pending[i][1]) + "\n")
+                    i += 1
+                    continue
+                out.write(l if l.endswith("\n") else l + "\n")
+            for (key, entry) in pending[i:]:
+                out.write(":".join(entry) + "\n")
+        os.replace(tmp_path, self.path)
+        os.remove(self.journal_path)
+        self.pending = {}
+
+    def export(self, out_path):
+        """
+        Writes all entries as a 'geoid:info' text file, sorted by location.
+        Returns whether the export changed.
+        """
+        changed = bool(self.pending)
+        self.compact()
+        if not changed and os.path.exists(out_path) and \
+                os.path.getmtime(out_path) == os.path.getmtime(self.path):
+            return False
+        # This keeps the index's modification time, so that we can tell when
+        # the export gets changed by someone else.
+        shutil.copy2(self.path, out_path)
+        return True
+
+
+def add_if_more_precise(entries, entry):
+    key = sort_key(entry[0])
+    existing = entries.get(key)
+    if is_more_precise(entry[1], existing[1] if existing else None):
+        entries[key] = entry
+
+
+def write_sorted(path, entries):
+    with open(path, "w", encoding="utf-8") as f:
+        for key in sorted(entries.keys()):
+            f.write(":".join(entries[key]) + "\n")
+        f.close()
+
+
+def find_sorted(f, size, key):
+    """
+    Binary searches the sorted file 'f' of 'size' bytes, opened in binary
+    mode, for the entry with the given sort key, and returns it as a
+    (geo ID, info) pair or None.
+    """
+    lo = 0
+    hi = size
+    # Find the smallest offset from which the next line's key is >= key.
+    while lo < hi:
+        mid = (lo + hi) // 2
+        entry = first_entry_from(f, mid)
+        if entry is None or sort_key(entry[0]) >= key:
+            hi = mid
+        else:
+            lo = mid + 1
+    entry = first_entry_from(f, lo)
+    if entry is not None and sort_key(entry[0]) == key:
+        return entry
+    return None
+
+
+def first_entry_from(f, offset):
+    """Returns the first entry on a line starting at or after 'offset'."""
+    if offset == 0:
+        f.seek(0)
+    else:
+        # Move past the end of the line the byte before 'offset' belongs to.
+        f.seek(offset - 1)
+        f.readline()
+    while True:
+        l = f.readline()
+        if not l:
+            return None
+        entry = parse_line(l.decode("utf-8"))
+        if entry:
+            return entry
@@ -0,0 +1,118 @@
+"""
+Writes precompressed '.gz' siblings of output files (and '.br' ones when the
+brotli module is installed), so that servers can send them as they are
+instead of compressing the data for every request.
+
+The content hash of each compressed file is recorded in a 'precompressed.json'
+manifest in its directory. Files whose content hasn't changed since they
+were last compressed are skipped, and servers can use the hashes as ETags.
+"""
+
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST_FILE_NAME = "precompressed.json"
+
+# Below this many files, a process pool isn't worth starting.
+MIN_FILES_FOR_POOL = 8
+
+
+def load_manifest(directory):
+    path = os.path.join(directory, MANIFEST_FILE_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        manifest = json.loads(f.read())
+        f.close()
+    return manifest
+
+
+def save_manifest(directory, manifest):
+    with open(os.path.join(directory, MANIFEST_FILE_NAME), "w") as f:
+        f.write(json.dumps(manifest, indent=1, sort_keys=True))
+        f.close()
+
+
+def sibling_suffixes(with_brotli):
+    if with_brotli and brotli is not None:
+        return [".gz", ".br"]
+    return [".gz"]
+
+
+def write_sibling(path, content):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+        f.close()
+    os.replace(tmp_path, path)
+
+
+def compress_file(path, known_hash, with_brotli):
+    """
+    Compresses 'path' unless its content still has the hash 'known_hash' and
+    its siblings exist. Returns (path, content hash, whether it compressed).
+    """
+    with open(path, "rb") as f:
+        content = f.read()
+        f.close()
+    digest = hashlib.sha1(content).hexdigest()
+    siblings = [path + suffix for suffix in sibling_suffixes(with_brotli)]
+    if digest == known_hash and all([os.path.exists(s) for s in siblings]):
+        # The file may have been rewritten with the same content; keep the
+        # siblings at least as recent so that they're still used.
+        mtime = os.path.getmtime(path)
+        for s in siblings:
+            if os.path.getmtime(s) < mtime:
+                os.utime(s, (mtime, mtime))
+        return (path, digest, False)
+    # A fixed modification time keeps the gzip output reproducible.
+    write_sibling(path + ".gz", gzip.compress(content, 9, mtime=0))
+    if with_brotli and brotli is not None:
+        write_sibling(path + ".br", brotli.compress(content))
+    return (path, digest, True)
+
+
+def precompress(paths, n_workers=None, with_brotli=True, quiet=False):
+    """
+    Writes the compressed siblings of the files in 'paths' whose content
+    changed, across a pool of 'n_workers' processes (all CPUs by default).
+    Returns the number of files that were compressed.
+    """
+    paths = [p for p in paths if os.path.exists(p)]
+    manifests = {}
+    tasks = []
+    for p in paths:
+        directory = os.path.dirname(os.path.abspath(p))
+        if directory not in manifests:
+            manifests[directory] = load_manifest(directory)
+        known_hash = manifests[directory].get(os.path.basename(p))
+        tasks.append((p, known_hash, with_brotli))
+
+    if len(tasks) < MIN_FILES_FOR_POOL:
+        results = [compress_file(*t) for t in tasks]
+    else:
+        pool = multiprocessing.Pool(n_workers or multiprocessing.cpu_count())
+        results = pool.starmap(compress_file, tasks, chunksize=4)
+        pool.close()
+        pool.join()
+
+    compressed = 0
+    for (path, digest, did_compress) in results:
+        directory = os.path.dirname(os.path.abspath(path))
+        manifests[directory][os.path.basename(path)] = digest
+        if did_compress:
+            compressed += 1
+    for directory in manifests:
+        save_manifest(directory, manifests[directory])
+    if not quiet:
+        print("Compressed " + str(compressed) + " out of " + str(len(paths)) +
+              " files.")
+    return compressed
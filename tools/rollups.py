@@ -0,0 +1,115 @@
+"""
+Weekly and monthly rollups of the daily slices, for clients that show the
+timeline at a coarser resolution and don't need to fetch every day.
+
+A rollup slice is written for each period, as d/weekly/YYYY-MM-DD.json
+(weeks start on Mondays) or d/monthly/YYYY-MM-01.json, named after the
+period's first day, in the daily slice format plus the last date the period
+has data for:
+
+{"date": "YYYY-MM-DD", "end": "YYYY-MM-DD",
+ "features": [{"properties": {"geoid": "lat|long", "new": int,
+                              "total": int}}, ...]}
+
+where "new" is the sum of the period's new cases, and "total" the total at
+the end of the period, including them. Each period directory has its own
+index.txt, like d/.
+
+Rollups are computed from a case matrix (see case_matrix.py), by mapping
+each of its dates to its period and summing counts in a single pass.
+"""
+
+import json
+import os
+import re
+
+import numpy
+
+from tools import case_matrix
+from tools import slice_manifest
+
+PERIODS = ["weekly", "monthly"]
+DATE_FILE = re.compile(r"^\d{4}-\d{2}-\d{2}\.json$")
+
+
+def period_starts(dates, period):
+    """Returns the first day of the period of each of the ISO 'dates'."""
+    days = numpy.array(list(dates), dtype="datetime64[D]")
+    if period == "weekly":
+        # The epoch was a Thursday, i.e. 3 days after a Monday.
+        starts = days - (days.astype(numpy.int64) + 3) % 7
+    elif period == "monthly":
+        starts = days.astype("datetime64[M]").astype("datetime64[D]")
+    else:
+        raise ValueError("Unknown rollup period '" + period + "'")
+    return numpy.array([str(d) for d in starts], dtype=object)
+
+
+def roll_up(matrix, period):
+    """
+    Returns the matrix of new cases by period (labelled by their first day)
+    and geo ID, and the last date of each period.
+    """
+    starts = period_starts(matrix.dates, period)
+    (labels, period_of_date) = numpy.unique(starts, return_inverse=True)
+    indptr = numpy.asarray(matrix.indptr)
+    rows = numpy.repeat(period_of_date, numpy.diff(indptr))
+    rolled_up = case_matrix.from_coordinates(
+        labels, matrix.geoids, rows, numpy.asarray(matrix.indices),
+        numpy.asarray(matrix.data, dtype=numpy.int64))
+    ends = [matrix.dates[i] for i in
+            numpy.searchsorted(period_of_date, numpy.arange(len(labels)),
+                               side="right") - 1]
+    return (rolled_up, ends)
+
+
+def produce_rollup_slice(start, end, geoids, seen, totals, new_cases):
+    features = []
+    for (g, total) in zip(seen.tolist(), totals[seen].tolist()):
+        properties = {"geoid": geoids[g], "total": total}
+        new = new_cases.get(g, 0)
+        if new != 0:
+            properties["new"] = new
+        features.append({"properties": properties})
+    return {"date": start, "end": end, "features": features}
+
+
+def are_written(out_dir, periods=PERIODS):
+    """Returns whether a previous run wrote the rollups of all 'periods'."""
+    return all([os.path.exists(os.path.join(out_dir, period, "index.txt"))
+                for period in periods])
+
+
+def write_rollups(matrix, out_dir, periods=PERIODS):
+    """
+    Writes the rollups of a case matrix with sorted, normalized dates under
+    'out_dir', removing periods left over from a previous run. Returns the
+    paths of the written files.
+    """
+    written = []
+    for period in periods:
+        period_dir = os.path.join(out_dir, period)
+        if not os.path.exists(period_dir):
+            os.makedirs(period_dir)
+        (rolled_up, ends) = roll_up(matrix, period)
+        first_seen = case_matrix.first_seen(rolled_up)
+        totals = numpy.zeros(len(rolled_up.geoids), dtype=numpy.int64)
+        for i in range(len(rolled_up.dates)):
+            (cols, counts) = case_matrix.day(rolled_up, i)
+            totals[cols] += counts
+            s = produce_rollup_slice(
+                rolled_up.dates[i], ends[i], rolled_up.geoids,
+                numpy.flatnonzero(first_seen <= i), totals,
+                dict(zip(cols.tolist(), counts.tolist())))
+            path = os.path.join(period_dir, rolled_up.dates[i] + ".json")
+            with open(path, "w") as f:
+                f.write(json.dumps(s))
+                f.close()
+            written.append(path)
+        file_names = set([d + ".json" for d in rolled_up.dates])
+        for file_name in os.listdir(period_dir):
+            if DATE_FILE.match(file_name) and file_name not in file_names:
+                os.remove(os.path.join(period_dir, file_name))
+        slice_manifest.write_index(period_dir, rolled_up.dates)
+        written.append(os.path.join(period_dir, "index.txt"))
+    return written
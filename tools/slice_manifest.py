@@ -0,0 +1,111 @@
+"""
+Keeps track of what went into the daily slices in a manifest stored next to
+the slices' 'index.txt', so that an update only rewrites the slices that
+actually changed.
+"""
+
+import hashlib
+import json
+import os
+
+import pandas
+
+MANIFEST_FILE_NAME = "manifest.json"
+
+
+def empty_manifest(options=None):
+    return {"sources": {}, "dates": {}, "options": dict(options or {})}
+
+
+def load(out_dir, options=None):
+    """
+    Returns the manifest stored in 'out_dir'. If the slices there were
+    written with different output 'options' (e.g. another format), an empty
+    manifest is returned so that everything gets rewritten.
+    """
+    path = os.path.join(out_dir, MANIFEST_FILE_NAME)
+    if not os.path.exists(path):
+        return empty_manifest(options)
+    with open(path) as f:
+        manifest = json.loads(f.read())
+        f.close()
+    if manifest.get("options", {}) != dict(options or {}):
+        return empty_manifest(options)
+    return manifest
+
+
+def save(out_dir, manifest):
+    with open(os.path.join(out_dir, MANIFEST_FILE_NAME), "w") as f:
+        f.write(json.dumps(manifest, indent=1, sort_keys=True))
+        f.close()
+
+
+def hash_new_cases(new_cases):
+    """
+    Returns a content hash for a single day of new cases, given as an
+    iterable of (geo ID, count) pairs. Zero counts are ignored, so that a
+    location that simply didn't have cases doesn't change the hash.
+    """
+    h = hashlib.sha1()
+    for (geoid, count) in sorted(new_cases):
+        if count != 0:
+            h.update((geoid + ":" + str(int(count)) + "\n").encode())
+    return h.hexdigest()
+
+
+def hash_frame(df):
+    """Returns a content hash for a whole data frame."""
+    h = hashlib.sha1()
+    h.update(pandas.util.hash_pandas_object(df, index=True).values.tobytes())
+    h.update(",".join([str(c) for c in df.columns]).encode())
+    return h.hexdigest()
+
+
+def hash_file(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+        f.close()
+    return h.hexdigest()
+
+
+def dates_to_rewrite(manifest, date_hashes, out_dir):
+    """
+    Returns the sorted list of dates whose slice needs to be written, given
+    the new hash of each date's new cases. Since totals accumulate, once a
+    date has changed every later slice has to be rewritten too.
+    """
+    dates = sorted(date_hashes.keys())
+    previous = manifest["dates"]
+    earliest_change = None
+    # A date that disappeared from the input changes the totals after it.
+    for date in previous:
+        if date not in date_hashes:
+            if earliest_change is None or date < earliest_change:
+                earliest_change = date
+    for date in dates:
+        if earliest_change is not None and date >= earliest_change:
+            break
+        if previous.get(date) != date_hashes[date] or not os.path.exists(
+                os.path.join(out_dir, date + ".json")):
+            earliest_change = date
+            break
+    if earliest_change is None:
+        return []
+    return [d for d in dates if d >= earliest_change]
+
+
+def update(out_dir, manifest, date_hashes, sources=None):
+    manifest["dates"] = dict(date_hashes)
+    if sources:
+        manifest["sources"] = dict(sources)
+    save(out_dir, manifest)
+
+
+def write_index(out_dir, dates):
+    with open(os.path.join(out_dir, "index.txt"), "w") as f:
+        # Reverse-sort the index file so that the browser will fetch recent
+        # slices first.
+        f.write("\n".join(sorted([d + ".json" for d in dates], reverse=True)))
+        f.close()
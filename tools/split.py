@@ -4,9 +4,17 @@ import json
 import os
 import multiprocessing
 
-import country_converter
+import numpy
+import pandas
 
-from tools import data_util
+from tools import calculate_data_freshness_per_country
+from tools import case_matrix
+from tools import country_resolution
+from tools import delta_slices
+from tools import precompress
+from tools import rollups
+from tools import slice_manifest
+from tools import tiles
 
 def normalize_date(date):
     """Returns a normalized string representation of a date string."""
@@ -40,100 +48,257 @@ def write_out(json_data, out_path, overwrite=True):
         f.write(json.dumps(json_data))
 
 
-def slice_by_day_and_export(full, out_dir, overwrite=True, quiet=False):
-    full.index = [normalize_date(x) for x in full.index]
-    full.index.name = "date"
-    full = full.sort_values(by="date")
+def slice_by_day_and_export(full, out_dir, overwrite=True, quiet=False,
+                            incremental=True, sources=None,
+                            keyframe_interval=0, tile_size=0):
+    """
+    Writes one slice per date into 'out_dir', given the new cases as a
+    case_matrix.CaseMatrix with normalized dates (or as a data frame of
+    dates x geo IDs, which is converted to one). When 'incremental' is set,
+    only the slices from the earliest date whose new cases differ from what
+    the manifest recorded onwards are recomputed and rewritten. 'sources' is
+    an optional dictionary of input source names to content hashes, which
+    are recorded in the manifest. A non-zero 'keyframe_interval' writes
+    slices in the delta format (see delta_slices.py). A non-zero 'tile_size'
+    also writes each slice split into tiles of that many degrees (see
+    tiles.py). Weekly and monthly rollups are also written (see rollups.py).
+    """
+    if isinstance(full, pandas.DataFrame):
+        full = full.copy()
+        full.index = [normalize_date(x) for x in full.index]
+        full = case_matrix.from_frame(full)
+    dates = list(full.dates)
 
-    new_cases = full
-    total_cases = new_cases.cumsum()
+    date_hashes = {}
+    for i in range(len(dates)):
+        (cols, counts) = case_matrix.day(full, i)
+        date_hashes[dates[i]] = slice_manifest.hash_new_cases(
+            zip(full.geoids[cols], counts.tolist()))
 
-    n_cpus = multiprocessing.cpu_count()
+    options = {"keyframe_interval": keyframe_interval}
+    if tile_size:
+        options["tile_size"] = tile_size
+    manifest = slice_manifest.empty_manifest(options)
+    if incremental:
+        manifest = slice_manifest.load(out_dir, options)
+    to_rewrite = set(slice_manifest.dates_to_rewrite(manifest, date_hashes,
+                                                     out_dir))
     if not quiet:
-        print("Processing " + str(len(full)) + " features "
-              "with " + str(n_cpus) + " threads...")
-
-    pool = multiprocessing.Pool(n_cpus)
-    out_slices = pool.starmap(produce_daily_slice,
-                              chunks(new_cases, total_cases, quiet),
-                              chunksize=10)
-    index = []
-    for s in out_slices:
-        out_name = s["date"] + ".json"
-        daily_slice_file_path = os.path.join(out_dir, out_name)
-        index.append(out_name)
-
-        write_out(s, daily_slice_file_path, overwrite)
-
-        with open(os.path.join(out_dir, "index.txt"), "w") as f:
-            # Reverse-sort the index file so that the browser will fetch recent
-            # slices first.
-            f.write("\n".join(sorted(index, reverse=True)))
-            f.close()
-
-
-def produce_daily_slice(new_cases, total_cases):
-    # full starts from new cases by location/date
+        print(str(len(to_rewrite)) + " out of " + str(len(dates)) + " daily "
+              "slices have changed.")
+    written = []
+    positions = [i for i in range(len(dates)) if dates[i] in to_rewrite]
+    if positions:
+        n_cpus = multiprocessing.cpu_count()
+        if not quiet:
+            print("Processing " + str(len(positions)) + " daily slices "
+                  "with " + str(n_cpus) + " threads...")
+        # A few runs of consecutive dates per worker, since each run starts
+        # by summing up all the cases before it.
+        run_length = max(1, -(-len(positions) // (n_cpus * 4)))
+        runs = [positions[k:k + run_length]
+                for k in range(0, len(positions), run_length)]
+        pool = multiprocessing.Pool(
+            n_cpus, initializer=init_day_worker,
+            initargs=(full, out_dir, overwrite, keyframe_interval, tile_size))
+        for paths in pool.imap(write_daily_slices, runs):
+            written += paths
+        pool.close()
+        pool.join()
+    tiles.remove_stale(out_dir, dates if tile_size else [])
+
+    # Rollups only change along with the daily slices. When some did, they
+    # are cheap enough to all be rewritten, and precompression skips the ones
+    # that didn't change.
+    if positions or set(manifest["dates"]) != set(dates) or \
+            not rollups.are_written(out_dir):
+        written += rollups.write_rollups(full, out_dir)
+    slice_manifest.write_index(out_dir, date_hashes.keys())
+    slice_manifest.update(out_dir, manifest, date_hashes, sources)
+    precompress.precompress(written + [os.path.join(out_dir, "index.txt")],
+                            quiet=quiet)
+
+
+# The case matrix and options used by daily slicing workers, see
+# init_day_worker.
+_days = None
+
+
+def init_day_worker(matrix, out_dir, overwrite, keyframe_interval,
+                    tile_size):
+    global _days
+    _days = {"matrix": matrix, "first_seen": case_matrix.first_seen(matrix),
+             "out_dir": out_dir, "overwrite": overwrite,
+             "keyframe_interval": keyframe_interval, "tile_size": tile_size}
+
+
+def write_daily_slices(positions):
+    """
+    Writes the daily slices of the dates at the given sorted 'positions' of
+    the matrix set by init_day_worker. Totals are carried from one date to
+    the next, so each date only costs its own non-zero counts on top of
+    listing its features. Returns the written paths.
+    """
+    matrix = _days["matrix"]
+    dates = matrix.dates
+    out_dir = _days["out_dir"]
+    tile_size = _days["tile_size"]
+    totals = case_matrix.totals_before(matrix, positions[0])
+    to_write = set(positions)
+    written = []
+    for i in range(positions[0], positions[-1] + 1):
+        (cols, counts) = case_matrix.day(matrix, i)
+        totals[cols] += counts
+        if i not in to_write:
+            continue
+        new_cases = dict(zip(cols.tolist(), counts.tolist()))
+        keyframe = delta_slices.keyframe_for(
+            dates, i, _days["keyframe_interval"])
+        if keyframe is None or keyframe == dates[i] or tile_size:
+            seen = numpy.flatnonzero(_days["first_seen"] <= i)
+        else:
+            # Deltas only list the locations with new cases.
+            seen = numpy.sort(cols)
+        s = produce_daily_slice(dates[i], matrix.geoids, seen, totals,
+                                new_cases)
+        out_path = os.path.join(out_dir, dates[i] + ".json")
+        write_out(delta_slices.encode(s, keyframe), out_path,
+                  _days["overwrite"])
+        written.append(out_path)
+        if tile_size:
+            written += tiles.write_tiled_slice(s, out_dir, tile_size)
+    return written
+
+
+def produce_daily_slice(date, geoids, seen, totals, new_cases):
     # structure for daily slice YYYY-MM-DD.json
     # {"date": "YYYY-MM-DD", "features": [{"properties": {"geoid": "lat|long",
     # "new": int, "total": int}}, ... ]
-
-    assert new_cases.name == total_cases.name, "mismatched dates"
+    # 'seen' are the positions of the geo IDs to list, 'totals' the total by
+    # geo ID position, including this date's, and 'new_cases' a dictionary
+    # of this date's non-zero new cases by geo ID position.
 
     features = []
 
-    for geoid in new_cases.index:
-        new = int(new_cases[geoid])
-        total = int(total_cases[geoid])
+    for (g, total) in zip(seen.tolist(), totals[seen].tolist()):
+        new = new_cases.get(g, 0)
         if new == total == 0:
             continue
-        properties = {"geoid": geoid, "total": total}
+        properties = {"geoid": geoids[g], "total": total}
         if new != 0:
             properties["new"] = new
 
         features.append({"properties": properties})
 
-    return {"date": new_cases.name, "features": features}
+    return {"date": date, "features": features}
+
 
-def write_single_country_data(iso_code, data_frame, out_dir, overwrite=True):
+# The date and geo ID labels used by country slicing workers. They are sent
+# once to each worker, so that tasks only carry arrays of integer codes.
+_date_labels = None
+_geoid_labels = None
+
+
+def init_country_worker(date_labels, geoid_labels):
+    global _date_labels, _geoid_labels
+    _date_labels = date_labels
+    _geoid_labels = geoid_labels
+
+
+def write_single_country_data_from_codes(iso_code, date_codes, geoid_codes,
+                                         out_dir, overwrite=True,
+                                         case_counts=None):
+    """
+    Writes the file of one country, whose new cases by date and geo ID are
+    given as its line list, in arrays of codes into the labels set by
+    init_country_worker. Date and geo ID codes must sort the same way as
+    their labels. If given, 'case_counts' is the number of cases each row
+    stands for. Returns the file's name and latest date if it was written,
+    None otherwise.
+    """
+    # Dates are listed in order, so that the latest one ends the file, and
+    # cases without a geo ID still make their date appear.
+    has_date = date_codes >= 0
+    (date_index, local_dates) = pandas.factorize(date_codes[has_date],
+                                                 sort=True)
+    has_geoid = geoid_codes[has_date] >= 0
+    (local_geoids, geoid_index) = numpy.unique(
+        geoid_codes[has_date][has_geoid], return_inverse=True)
+    date_index = date_index[has_geoid]
+    weights = None
+    if case_counts is not None:
+        weights = case_counts[has_date][has_geoid]
+    counts = numpy.bincount(date_index * len(local_geoids) + geoid_index,
+                            weights=weights,
+                            minlength=len(local_dates) * len(local_geoids))
+    counts = counts.reshape((len(local_dates), len(local_geoids)))
 
-    # A dictionary where the keys are date strings, and values are themselves
-    # dictionaries from geo ID to the number of new cases on that day and
-    # location.
     new_cases_by_day = {}
-    data_frame = data_frame.drop(["country"], axis=1)
-    case_count_table = data_util.build_case_count_table_from_line_list(
-        data_frame)
-
-    case_count_dict = case_count_table.to_dict("split")
-    for i in range(len(case_count_dict["index"])):
-        date = case_count_dict["index"][i]
-        new_cases_by_day[date] = {}
-        for j in range(len(case_count_dict["columns"])):
-            geoid = case_count_dict["columns"][j]
-            count = case_count_dict["data"][i][j]
-            if count > 0:
-                new_cases_by_day[date][geoid] = int(case_count_dict["data"][i][j])
+    for i in range(len(local_dates)):
+        day = {}
+        for j in numpy.flatnonzero(counts[i]):
+            day[_geoid_labels[local_geoids[j]]] = int(counts[i][j])
+        new_cases_by_day[_date_labels[local_dates[i]]] = day
     slice_file_path = os.path.join(out_dir, iso_code + ".json")
+    existed = os.path.exists(slice_file_path)
     write_out(new_cases_by_day, slice_file_path, overwrite)
+    if existed and not overwrite:
+        return None
+    return (iso_code + ".json", max(new_cases_by_day.keys(), default=""))
 
 
-def slice_by_country_and_export(data_frame, out_dir, overwrite=True, quiet=False):
-
-    groups = data_frame.groupby("country")
+def slice_by_country_and_export(data_frame, out_dir, overwrite=True, quiet=False,
+                                n_workers=None):
+    """
+    Writes one file per country into 'out_dir', using a pool of 'n_workers'
+    processes (all CPUs by default). If the data frame has a "count" column,
+    each row stands for that many cases.
+    """
     if not os.path.exists(out_dir):
         os.mkdir(out_dir)
-    for g in groups:
-        (country, frame) = g
-        code = country_converter.code_from_name(country.lower())
-        write_single_country_data(code, frame, out_dir, overwrite)
 
+    (date_codes, date_labels) = pandas.factorize(data_frame.date, sort=True)
+    (geoid_codes, geoid_labels) = pandas.factorize(data_frame.geoid, sort=True)
+    (country_codes, countries) = pandas.factorize(data_frame.country, sort=True)
+    # Group rows by country, keeping their original order within a country.
+    order = numpy.argsort(country_codes, kind="stable")
+    bounds = numpy.searchsorted(country_codes[order],
+                                numpy.arange(len(countries) + 1))
+    case_counts = None
+    if "count" in data_frame.columns:
+        case_counts = data_frame["count"].values.astype(numpy.int64)
 
-def chunks(new_cases, total_cases, quiet=False):
-    """
-    Yields successive equal-sized chunks from the input list.
-    """
-    for i in range(len(new_cases)):
-        if not quiet:
-            print(".", end="", flush=True)
-        yield (new_cases.iloc[i], total_cases.iloc[i])
+    tasks = {}
+    for i in range(len(countries)):
+        (ignored, code) = country_resolution.resolve(
+            countries[i].lower(), int(bounds[i + 1] - bounds[i]))
+        if code is None:
+            # Countries that are ignored on purpose aren't worth a note.
+            if not ignored:
+                print("Note: I couldn't find country '" + countries[i] + "'")
+            continue
+        if code in tasks and not overwrite:
+            print("I won't clobber '" + code + ".json', please delete it first.")
+            continue
+        rows = order[bounds[i]:bounds[i + 1]]
+        # Several country names can map to the same code, the last one wins.
+        tasks[code] = (code, date_codes[rows].astype(numpy.int32),
+                       geoid_codes[rows].astype(numpy.int32), out_dir, overwrite,
+                       None if case_counts is None else case_counts[rows])
+
+    if not n_workers:
+        n_workers = multiprocessing.cpu_count()
+    if not quiet:
+        print("Writing " + str(len(tasks)) + " country slices "
+              "with " + str(n_workers) + " processes...")
+    pool = multiprocessing.Pool(n_workers, initializer=init_country_worker,
+                                initargs=(list(date_labels), list(geoid_labels)))
+    written = pool.starmap(write_single_country_data_from_codes,
+                           tasks.values())
+    pool.close()
+    pool.join()
+    # Freshness can then be computed without reading the files back.
+    calculate_data_freshness_per_country.record(
+        out_dir, dict([w for w in written if w]))
+    precompress.precompress([os.path.join(out_dir, code + ".json")
+                             for code in tasks], quiet=quiet)
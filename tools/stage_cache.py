@@ -0,0 +1,115 @@
+"""
+An on-disk cache of pipeline stage outputs, keyed by a hash of the stage's
+name, version and inputs (typically content hashes of source files, and
+parameters). A stage whose inputs haven't changed since a previous run can
+load its outputs from the cache instead of being recomputed.
+
+Entries are pickled into one file each. The cache is bounded in size: when
+it grows past its limit, the least recently used entries are evicted.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import tempfile
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+ENTRY_SUFFIX = ".pkl"
+
+
+class StageCache:
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + ENTRY_SUFFIX)
+
+    def get(self, key):
+        """Returns the value stored for 'key', or None if there's none."""
+        path = self.entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+                f.close()
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        # The modification time tells which entries were used last.
+        os.utime(path)
+        return value
+
+    def put(self, key, value):
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.close()
+        os.replace(tmp_path, self.entry_path(key))
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until under the limit."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            st = os.stat(os.path.join(self.cache_dir, name))
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum([e[1] for e in entries])
+        for (mtime, size, name) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
+
+    def memoize(self, key, compute):
+        """
+        Returns the cached value for 'key', computing and storing it with
+        'compute()' if it isn't there.
+        """
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+
+def make_key(stage_name, version, *inputs):
+    """
+    Returns the cache key of a stage. 'version' must be changed whenever the
+    stage's code changes in a way that affects its outputs. 'inputs' are
+    JSON-serializable values, like content hashes and parameters.
+    """
+    description = json.dumps([stage_name, version] + list(inputs),
+                             sort_keys=True)
+    return stage_name + "-" + hashlib.sha1(
+        description.encode("utf-8")).hexdigest()
+
+
+def hash_modules(*modules):
+    """
+    Returns a hash of the source code of 'modules'. Stages that use code
+    from outside this repo (the common repo) can put it in their keys, since
+    their version doesn't change when that code does.
+    """
+    h = hashlib.sha1()
+    for module in modules:
+        with open(inspect.getsourcefile(module), "rb") as f:
+            h.update(f.read())
+            f.close()
+    return h.hexdigest()
+
+
+def hash_bytes(content):
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha1(content).hexdigest()
+
+
+def open_cache(cache_dir):
+    """Returns a StageCache for 'cache_dir', or None if it is None."""
+    return StageCache(cache_dir) if cache_dir else None
@@ -0,0 +1,156 @@
+"""
+Deterministic generators for synthetic versions of the pipeline's inputs:
+latestdata.csv, the JHU US time series CSV and Global.health cases.json
+dumps. Given the same parameters and seed, the output is always the same,
+so that benchmark runs can be compared with each other.
+"""
+
+import json
+import os
+
+import numpy
+import pandas
+
+# Country names the country converter knows about, with rough bounding
+# boxes (min lat, max lat, min lng, max lng) to place locations in.
+COUNTRIES = [
+    ("France", 43, 50, -4, 7), ("Germany", 48, 54, 6, 14),
+    ("Italy", 37, 46, 7, 18), ("Spain", 36, 43, -9, 3),
+    ("China", 22, 45, 90, 122), ("Japan", 31, 45, 130, 145),
+    ("Brazil", -30, 0, -60, -35), ("India", 8, 32, 70, 88),
+    ("Mexico", 16, 31, -115, -88), ("Peru", -17, -1, -80, -70),
+    ("Argentina", -50, -23, -70, -58), ("Canada", 43, 60, -125, -65),
+]
+
+START_DATE = pandas.Timestamp("2020-01-15")
+CHUNK_SIZE = 500000
+
+
+def generate_locations(n_geoids, seed=0):
+    """Returns a data frame of locations with a country, names and lat/lng."""
+    rng = numpy.random.RandomState(seed)
+    country_index = rng.randint(0, len(COUNTRIES), n_geoids)
+    bounds = numpy.array([c[1:] for c in COUNTRIES], dtype=float)[country_index]
+    return pandas.DataFrame({
+        "country": numpy.array([c[0] for c in COUNTRIES])[country_index],
+        "province": ["Province " + str(i % 97) for i in range(n_geoids)],
+        "city": ["City " + str(i) for i in range(n_geoids)],
+        "latitude": numpy.round(rng.uniform(bounds[:, 0], bounds[:, 1]), 6),
+        "longitude": numpy.round(rng.uniform(bounds[:, 2], bounds[:, 3]), 6),
+    })
+
+
+def sample_cases(n_cases, n_geoids, n_days, seed):
+    """
+    Yields (location index, day) arrays for 'n_cases' cases in chunks. A few
+    locations get most cases, and cases grow over time, as in real data.
+    """
+    rng = numpy.random.RandomState(seed)
+    popularity = 1.0 / numpy.arange(1, n_geoids + 1)
+    popularity /= popularity.sum()
+    growth = numpy.linspace(1, 20, n_days)
+    growth /= growth.sum()
+    for start in range(0, n_cases, CHUNK_SIZE):
+        n = min(CHUNK_SIZE, n_cases - start)
+        yield (rng.choice(n_geoids, n, p=popularity),
+               rng.choice(n_days, n, p=growth))
+
+
+def write_latest_data_csv(out_path, n_cases, n_geoids, n_days=365, seed=0):
+    locations = generate_locations(n_geoids, seed)
+    header = True
+    for (geo_index, day) in sample_cases(n_cases, n_geoids, n_days, seed + 1):
+        dates = (START_DATE + pandas.to_timedelta(day, unit="D")).strftime(
+            "%d.%m.%Y")
+        chunk = locations.iloc[geo_index].reset_index(drop=True)
+        chunk["latitude"] = chunk.latitude.astype(str)
+        chunk["longitude"] = chunk.longitude.astype(str)
+        chunk["date_confirmation"] = dates
+        chunk["date_admission_hospital"] = ""
+        # Sprinkle some of the messiness the filters have to deal with.
+        chunk.loc[chunk.index % 50 == 1, "date_confirmation"] = ""
+        chunk.loc[chunk.index % 50 == 1, "date_admission_hospital"] = \
+            dates[chunk.index % 50 == 1]
+        chunk.loc[chunk.index % 997 == 2, "date_confirmation"] = \
+            "01.03.2020 - 05.03.2020"
+        chunk.loc[chunk.index % 1009 == 3, "latitude"] = "unknown"
+        chunk.to_csv(out_path, mode="w" if header else "a", header=header,
+                     index=False)
+        header = False
+
+
+def write_jhu_csv(out_path, n_counties, n_days=365, seed=0):
+    """Writes a JHU-style US time series of cumulative confirmed cases."""
+    rng = numpy.random.RandomState(seed)
+    dates = START_DATE + pandas.to_timedelta(numpy.arange(n_days), unit="D")
+    columns = [str(d.month) + "/" + str(d.day) + "/" + d.strftime("%y")
+               for d in dates]
+    new_cases = rng.poisson(rng.uniform(0, 5, (n_counties, 1)),
+                            (n_counties, n_days))
+    df = pandas.DataFrame({
+        "UID": numpy.arange(n_counties) + 84000000,
+        "iso2": "US",
+        "iso3": "USA",
+        "code3": 840,
+        "FIPS": numpy.arange(n_counties) + 1000.0,
+        "Admin2": ["County " + str(i) for i in range(n_counties)],
+        "Province_State": ["State " + str(i % 50) for i in range(n_counties)],
+        "Country_Region": "US",
+        "Lat": numpy.round(rng.uniform(25, 49, n_counties), 8),
+        "Long_": numpy.round(rng.uniform(-124, -67, n_counties), 8),
+        "Combined_Key": ["County " + str(i) + ", US" for i in range(n_counties)],
+    })
+    cumulative = pandas.DataFrame(numpy.cumsum(new_cases, axis=1),
+                                  columns=columns)
+    pandas.concat([df, cumulative], axis=1).to_csv(out_path, index=False)
+
+
+def write_cases_json(out_path, n_cases, n_geoids, n_days=365, seed=0):
+    """Writes a cases.json dump, i.e. a JSON array of case objects."""
+    locations = generate_locations(n_geoids, seed).to_dict("records")
+    first = True
+    with open(out_path, "w") as f:
+        f.write("[")
+        for (geo_index, day) in sample_cases(n_cases, n_geoids, n_days,
+                                             seed + 1):
+            dates = (START_DATE + pandas.to_timedelta(day, unit="D")).strftime(
+                "%Y-%m-%dT00:00:00.000Z")
+            for i in range(len(geo_index)):
+                loc = locations[geo_index[i]]
+                case = {
+                    "location": {
+                        "country": loc["country"],
+                        "administrativeAreaLevel1": loc["province"],
+                        "administrativeAreaLevel3": loc["city"],
+                        "geometry": {"latitude": loc["latitude"],
+                                     "longitude": loc["longitude"]},
+                    },
+                    "events": [{"name": "confirmed", "dateRange": {
+                        "start": {"$date": dates[i]},
+                        "end": {"$date": dates[i]}}}],
+                }
+                f.write(("" if first else ",\n") + json.dumps(case))
+                first = False
+        f.write("]")
+        f.close()
+
+
+def generate_all(out_dir, n_cases, n_geoids, n_days=365, seed=0):
+    """
+    Writes all synthetic inputs into 'out_dir', unless they're already there.
+    Returns the paths of the latest data CSV, JHU CSV and cases dump.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    paths = [os.path.join(out_dir, name) for name in
+             ["latestdata.csv", "jhu_us.csv", "cases.json"]]
+    writers = [
+        lambda p: write_latest_data_csv(p, n_cases, n_geoids, n_days, seed),
+        lambda p: write_jhu_csv(p, max(1, n_geoids // 20), n_days, seed),
+        lambda p: write_cases_json(p, n_cases, n_geoids, n_days, seed),
+    ]
+    for (path, write) in zip(paths, writers):
+        if not os.path.exists(path):
+            write(path + ".tmp")
+            os.replace(path + ".tmp", path)
+    return paths
@@ -0,0 +1,188 @@
+"""
+An optional, spatially tiled layout for daily slices, so that clients can
+fetch only the part of the world they show.
+
+The features of a daily slice are split along a fixed grid of 'tile_size'
+degree squares, by the latitude and longitude in their geo ID, and written
+as d/tiles/YYYY-MM-DD/<row>_<column>.json, each in the regular daily slice
+format. Rows count from the south pole and columns from the antimeridian.
+An index.json file in each date's directory lists its tiles:
+
+{"date": "YYYY-MM-DD", "tile_size": 10,
+ "tiles": {"<row>_<column>": {"bbox": [west, south, east, north],
+                               "features": int}, ...}}
+
+Bounding boxes are given as [west, south, east, north] in degrees, as in
+GeoJSON. A box whose west is greater than its east crosses the antimeridian.
+"""
+
+import functools
+import json
+import math
+import os
+import shutil
+
+TILES_DIR_NAME = "tiles"
+TILE_INDEX_FILE_NAME = "index.json"
+DEFAULT_TILE_SIZE = 10
+
+
+def tile_rows(tile_size):
+    return int(math.ceil(180.0 / tile_size))
+
+
+def tile_columns(tile_size):
+    return int(math.ceil(360.0 / tile_size))
+
+
+def tile_at(lat, lng, tile_size):
+    """Returns the (row, column) of the tile containing a location."""
+    row = int(math.floor((lat + 90) / tile_size))
+    column = int(math.floor((lng + 180) / tile_size))
+    # The north pole and the antimeridian belong to the last row and column.
+    return (min(max(row, 0), tile_rows(tile_size) - 1),
+            min(max(column, 0), tile_columns(tile_size) - 1))
+
+
+@functools.lru_cache(maxsize=1 << 18)
+def tile_for_geoid(geoid, tile_size):
+    (lat, lng) = [float(x) for x in geoid.split("|")]
+    return tile_name(*tile_at(lat, lng, tile_size))
+
+
+def tile_name(row, column):
+    return str(row) + "_" + str(column)
+
+
+def tile_bbox(row, column, tile_size):
+    return [column * tile_size - 180, row * tile_size - 90,
+            min((column + 1) * tile_size - 180, 180),
+            min((row + 1) * tile_size - 90, 90)]
+
+
+def tiles_for_bbox(bbox, tile_size):
+    """Returns the names of all tiles intersecting the bounding box."""
+    (west, south, east, north) = bbox
+    (first_row, first_column) = tile_at(south, west, tile_size)
+    (last_row, last_column) = tile_at(north, east, tile_size)
+    if west <= east:
+        columns = list(range(first_column, last_column + 1))
+    else:
+        columns = list(range(first_column, tile_columns(tile_size))) + \
+            list(range(0, last_column + 1))
+    return [tile_name(row, column)
+            for row in range(first_row, last_row + 1) for column in columns]
+
+
+def split_slice(daily_slice, tile_size):
+    """Returns the features of a daily slice as a dictionary by tile name."""
+    tiles = {}
+    for f in daily_slice["features"]:
+        name = tile_for_geoid(f["properties"]["geoid"], tile_size)
+        if name not in tiles:
+            tiles[name] = []
+        tiles[name].append(f)
+    return tiles
+
+
+def date_dir(out_dir, date):
+    return os.path.join(out_dir, TILES_DIR_NAME, date)
+
+
+def write_tiled_slice(daily_slice, out_dir, tile_size=DEFAULT_TILE_SIZE):
+    """
+    Writes the tiles of a daily slice, and their index, under 'out_dir'.
+    Tiles the date had from a previous run but doesn't have anymore are
+    removed. Returns the paths of the written files.
+    """
+    date = daily_slice["date"]
+    tiles_dir = date_dir(out_dir, date)
+    if not os.path.exists(tiles_dir):
+        os.makedirs(tiles_dir)
+    tiles = split_slice(daily_slice, tile_size)
+    index = {"date": date, "tile_size": tile_size, "tiles": {}}
+    written = []
+    for name in sorted(tiles.keys()):
+        (row, column) = [int(x) for x in name.split("_")]
+        index["tiles"][name] = {"bbox": tile_bbox(row, column, tile_size),
+                                "features": len(tiles[name])}
+        path = os.path.join(tiles_dir, name + ".json")
+        write_json(path, {"date": date, "features": tiles[name]})
+        written.append(path)
+    for file_name in os.listdir(tiles_dir):
+        (name, ext) = os.path.splitext(file_name)
+        if ext == ".json" and name not in tiles and \
+                file_name != TILE_INDEX_FILE_NAME:
+            os.remove(os.path.join(tiles_dir, file_name))
+    path = os.path.join(tiles_dir, TILE_INDEX_FILE_NAME)
+    write_json(path, index)
+    written.append(path)
+    return written
+
+
+def remove_stale(out_dir, dates):
+    """
+    Removes the tiles of any date not in 'dates', i.e. all of them when the
+    slices aren't tiled anymore.
+    """
+    tiles_dir = os.path.join(out_dir, TILES_DIR_NAME)
+    if not os.path.isdir(tiles_dir):
+        return
+    dates = set(dates)
+    if not dates:
+        shutil.rmtree(tiles_dir)
+        return
+    for date in os.listdir(tiles_dir):
+        if date not in dates:
+            shutil.rmtree(os.path.join(tiles_dir, date))
+
+
+def write_json(path, obj):
+    with open(path, "w") as f:
+        f.write(json.dumps(obj))
+        f.close()
+
+
+def load_index(out_dir, date):
+    """Returns the tile index of a date, or None if it wasn't tiled."""
+    path = os.path.join(date_dir(out_dir, date), TILE_INDEX_FILE_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        index = json.loads(f.read())
+        f.close()
+    return index
+
+
+def tiles_covering(out_dir, date, bbox):
+    """
+    Returns the names of the tiles of a date that intersect the bounding
+    box and have features, or None if the date wasn't tiled.
+    """
+    index = load_index(out_dir, date)
+    if index is None:
+        return None
+    return [name for name in tiles_for_bbox(bbox, index["tile_size"])
+            if name in index["tiles"]]
+
+
+def read_features(out_dir, date, bbox):
+    """
+    Returns the features of a date's slice inside the bounding box, reading
+    only the tiles it intersects.
+    """
+    (west, south, east, north) = bbox
+    features = []
+    for name in tiles_covering(out_dir, date, bbox) or []:
+        with open(os.path.join(date_dir(out_dir, date),
+                               name + ".json")) as f:
+            tile = json.loads(f.read())
+            f.close()
+        for feature in tile["features"]:
+            (lat, lng) = [float(x) for x in
+                          feature["properties"]["geoid"].split("|")]
+            in_lng = west <= lng <= east if west <= east else \
+                lng >= west or lng <= east
+            if south <= lat <= north and in_lng:
+                features.append(feature)
+    return features
@@ -0,0 +1,151 @@
+"""
+Per-location time series of new and total case counts, so that the history
+of one geo ID can be read from one small file instead of every daily slice.
+
+The series are computed from a case matrix (see case_matrix.py) in a single
+pass, and written to 'out_dir' as buckets of consecutive geo IDs (in sorted
+order), each bucket being a JSON file:
+
+{"series": {"<geoid>": {"d": [date position, ...],
+                        "new": [new cases, ...],
+                        "total": [total cases, ...]}, ...}}
+
+Only the dates a geo ID had new cases on are listed; its total on any other
+date is the one of the last listed date before it. Date positions refer to
+the "dates" list of the index.json file next to the buckets:
+
+{"dates": ["YYYY-MM-DD", ...], "bucket_size": 1000,
+ "buckets": [{"file": "0.json", "first": geoid, "last": geoid}, ...]}
+
+Usage: python3 -m tools.timeseries OUT_DIR GEOID
+prints the time series of a geo ID as CSV.
+"""
+
+import bisect
+import json
+import os
+import sys
+
+import numpy
+
+from tools import split
+
+INDEX_FILE_NAME = "index.json"
+DEFAULT_BUCKET_SIZE = 1000
+
+
+def compute_series(matrix):
+    """
+    Returns the sorted dates, and the matrix's non-zero counts reordered by
+    geo ID then date as a CSR-like set of arrays: the entries of the geo ID
+    at position i are in [geo_indptr[i], geo_indptr[i + 1]) of 'date_index',
+    'new' and 'total'.
+    """
+    dates = numpy.array([split.normalize_date(d) for d in matrix.dates],
+                        dtype=object)
+    date_order = numpy.argsort(dates, kind="stable")
+    date_rank = numpy.zeros(len(dates), dtype=numpy.int64)
+    date_rank[date_order] = numpy.arange(len(dates))
+
+    indptr = numpy.asarray(matrix.indptr)
+    rows = numpy.repeat(numpy.arange(len(dates)), numpy.diff(indptr))
+    cols = numpy.asarray(matrix.indices).astype(numpy.int64)
+    keys = cols * max(len(dates), 1) + date_rank[rows]
+    order = numpy.argsort(keys, kind="stable")
+    date_index = date_rank[rows[order]]
+    new = numpy.asarray(matrix.data)[order].astype(numpy.int64)
+
+    geo_indptr = numpy.zeros(len(matrix.geoids) + 1, dtype=numpy.int64)
+    geo_indptr[1:] = numpy.cumsum(
+        numpy.bincount(cols, minlength=len(matrix.geoids)))
+    # A running sum over all entries, restarted at each geo ID's first one.
+    total = numpy.cumsum(new)
+    starts = geo_indptr[:-1]
+    offsets = numpy.concatenate([[0], total])[starts]
+    total -= numpy.repeat(offsets, numpy.diff(geo_indptr))
+    return (dates[date_order], geo_indptr, date_index, new, total)
+
+
+def export(matrix, out_dir, bucket_size=DEFAULT_BUCKET_SIZE, quiet=False):
+    """
+    Writes the time series of every geo ID of the matrix, and their index,
+    into 'out_dir', removing buckets left over from a previous run. Returns
+    the number of geo IDs written.
+    """
+    (dates, geo_indptr, date_index, new, total) = compute_series(matrix)
+    geoids = matrix.geoids
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    if not quiet:
+        print("Writing time series for " + str(len(geoids)) + " locations "
+              "into '" + out_dir + "'...")
+
+    index = {"dates": list(dates), "bucket_size": bucket_size, "buckets": []}
+    file_names = set()
+    for first in range(0, len(geoids), bucket_size):
+        last = min(first + bucket_size, len(geoids))
+        start = geo_indptr[first]
+        end = geo_indptr[last]
+        bucket_dates = date_index[start:end].tolist()
+        bucket_new = new[start:end].tolist()
+        bucket_total = total[start:end].tolist()
+        series = {}
+        for i in range(first, last):
+            (a, b) = (geo_indptr[i] - start, geo_indptr[i + 1] - start)
+            series[geoids[i]] = {"d": bucket_dates[a:b],
+                                 "new": bucket_new[a:b],
+                                 "total": bucket_total[a:b]}
+        file_name = str(len(index["buckets"])) + ".json"
+        write_json(os.path.join(out_dir, file_name), {"series": series})
+        file_names.add(file_name)
+        index["buckets"].append({"file": file_name, "first": geoids[first],
+                                 "last": geoids[last - 1]})
+
+    for file_name in os.listdir(out_dir):
+        if file_name.endswith(".json") and file_name not in file_names and \
+                file_name != INDEX_FILE_NAME:
+            os.remove(os.path.join(out_dir, file_name))
+    write_json(os.path.join(out_dir, INDEX_FILE_NAME), index)
+    return len(geoids)
+
+
+def write_json(path, obj):
+    with open(path, "w") as f:
+        f.write(json.dumps(obj, separators=(",", ":")))
+        f.close()
+
+
+def read_json(path):
+    with open(path) as f:
+        obj = json.loads(f.read())
+        f.close()
+    return obj
+
+
+def read_series(out_dir, geoid, index=None):
+    """
+    Returns the time series of a geo ID as a list of (date, new, total)
+    tuples, or None if it has none. Only the bucket holding it is read.
+    """
+    if index is None:
+        index = read_json(os.path.join(out_dir, INDEX_FILE_NAME))
+    firsts = [b["first"] for b in index["buckets"]]
+    position = bisect.bisect_right(firsts, geoid) - 1
+    if position < 0 or geoid > index["buckets"][position]["last"]:
+        return None
+    bucket = read_json(os.path.join(out_dir,
+                                    index["buckets"][position]["file"]))
+    series = bucket["series"].get(geoid)
+    if series is None:
+        return None
+    return [(index["dates"][d], n, t) for (d, n, t) in
+            zip(series["d"], series["new"], series["total"])]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    print("date,new,total")
+    for row in read_series(sys.argv[1], sys.argv[2]) or []:
+        print(",".join([str(x) for x in row]))
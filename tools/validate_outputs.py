@@ -0,0 +1,274 @@
+"""
+Checks that the generated daily slices (d/) and country files (c/) are
+consistent with each other and with the location info, before publishing:
+
+- in the daily slices, each location's total equals its previous total plus
+  its new cases (whether or not totals include the day's new cases, and in
+  the delta format as well, see delta_slices.py), totals never decrease and
+  locations never disappear once they have cases;
+- the country files' cases, in all and by location, are all found in the
+  dailies (the dailies also have the JHU US counts, so they can have more);
+- every geo ID in either is in location_info.data.
+
+Daily slices are checked in runs of consecutive dates, and country files
+counted, across a process pool. Each worker parses one file at a time, and
+the case counts of every file come from get_case_count, as for
+count_cases_in_json. The result is a JSON report.
+
+Usage: python3 -m tools.validate_outputs [--total-excludes-new] [ROOT_DIR]
+"""
+
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+from tools import location_index
+
+DATE_FILE = re.compile(r"^(\d{4}-\d{2}-\d{2})\.json$")
+COUNTRY_FILE = re.compile(r"^([A-Z]{2})\.json$")
+# How many individual problems of each kind the report lists.
+MAX_REPORTED_ERRORS = 20
+
+
+def get_case_count(j):
+    """
+    Returns the number of cases in the JSON text of a daily slice (the sum
+    of its new cases) or of a country file, or in its parsed object.
+    """
+    obj = json.loads(j) if isinstance(j, (str, bytes)) else j
+    if "date" in obj:
+        obj = obj["features"]
+        new_cases = 0
+        for f in obj:
+            if "properties" in f and "new" in f["properties"]:
+                new_cases += f["properties"]["new"]
+        return new_cases
+    if isinstance(obj, dict):
+        # Country files have counts by date, then by geo ID.
+        return sum([sum(day.values()) for day in obj.values()])
+    return len(obj)
+
+
+def read_json(path):
+    with open(path) as f:
+        obj = json.loads(f.read())
+        f.close()
+    return obj
+
+
+def list_dates(dailies_dir):
+    return sorted([m.group(1) for m in
+                   [DATE_FILE.match(f) for f in os.listdir(dailies_dir)] if m])
+
+
+def check_dailies(dailies_dir, dates, start, end, total_includes_new):
+    """
+    Checks the daily slices of dates[start:end], given the sorted list of
+    all 'dates'. The totals they start from are read from the slices before,
+    back to the nearest full one. Returns a summary of the run.
+    """
+    summary = {"dates": end - start, "features": 0, "cases": 0, "errors": [],
+               "error_count": 0, "new_by_geoid": {}, "totals": {}}
+    # The total of each location after the latest date read, which is the
+    # total the next slice starts from.
+    totals = {}
+    position = start - 1
+    first = start
+    while position >= 0:
+        daily_slice = read_json(os.path.join(dailies_dir,
+                                             dates[position] + ".json"))
+        keyframe = daily_slice.get("keyframe")
+        if keyframe is None or keyframe == dates[position]:
+            first = position
+            break
+        # A delta: go back to its keyframe.
+        position = dates.index(keyframe) if keyframe in dates else -1
+    if position < 0:
+        first = 0
+
+    def error(message):
+        summary["error_count"] += 1
+        if len(summary["errors"]) < MAX_REPORTED_ERRORS:
+            summary["errors"].append(message)
+
+    for i in range(first, end):
+        date = dates[i]
+        checked = i >= start
+        daily_slice = read_json(os.path.join(dailies_dir, date + ".json"))
+        if daily_slice.get("date") != date:
+            error(date + ": the slice says it's for '" +
+                  str(daily_slice.get("date")) + "'")
+        keyframe = daily_slice.get("keyframe")
+        is_delta = keyframe is not None and keyframe != date
+        includes_new = daily_slice.get("total_includes_new",
+                                       total_includes_new)
+        if checked:
+            summary["cases"] += get_case_count(daily_slice)
+        listed = set()
+        for f in daily_slice["features"]:
+            properties = f["properties"]
+            geoid = properties["geoid"]
+            new = properties.get("new", 0)
+            previous = totals.get(geoid, 0)
+            listed.add(geoid)
+            if checked:
+                summary["features"] += 1
+                summary["new_by_geoid"][geoid] = \
+                    summary["new_by_geoid"].get(geoid, 0) + new
+                if new < 0:
+                    error(date + ": " + geoid + " has " + str(new) +
+                          " new cases")
+            if is_delta:
+                totals[geoid] = previous + new
+                continue
+            total = properties.get("total", 0)
+            before = total - new if includes_new else total
+            if checked and before != previous:
+                error(date + ": " + geoid + " has a total of " + str(total) +
+                      " with " + str(new) + " new cases, after a total of " +
+                      str(previous))
+            totals[geoid] = before + new
+        if not is_delta:
+            for geoid in totals:
+                if geoid not in listed and totals[geoid] and checked:
+                    error(date + ": " + geoid + " disappeared after a total "
+                          "of " + str(totals[geoid]))
+    if end == len(dates):
+        summary["totals"] = totals
+    return summary
+
+
+def count_country_file(path):
+    """Returns the cases of a country file by geo ID, and their number."""
+    country = read_json(path)
+    cases = {}
+    for day in country.values():
+        for (geoid, count) in day.items():
+            cases[geoid] = cases.get(geoid, 0) + count
+    return (cases, get_case_count(country))
+
+
+def geoid_key(geoid):
+    """
+    Returns a geo ID's coordinates, since the location info can write them
+    with trailing zeros that slices don't have.
+    """
+    return tuple([float(x) for x in geoid.split("|")])
+
+
+def limited(items):
+    items = sorted(items)
+    return {"count": len(items), "examples": items[:MAX_REPORTED_ERRORS]}
+
+
+def validate(root_dir, total_includes_new=True, n_workers=None):
+    """
+    Checks the outputs under 'root_dir' and returns the report, whose "ok"
+    is whether no problem was found.
+    """
+    start_time = time.time()
+    dailies_dir = os.path.join(root_dir, "d")
+    countries_dir = os.path.join(root_dir, "c")
+    dates = list_dates(dailies_dir) if os.path.isdir(dailies_dir) else []
+    country_files = sorted([f for f in os.listdir(countries_dir)
+                            if COUNTRY_FILE.match(f)]) \
+        if os.path.isdir(countries_dir) else []
+
+    n_workers = n_workers or multiprocessing.cpu_count()
+    run_length = max(1, -(-len(dates) // (n_workers * 4)))
+    runs = [(dailies_dir, dates, k, min(k + run_length, len(dates)),
+             total_includes_new) for k in range(0, len(dates), run_length)]
+    pool = multiprocessing.Pool(n_workers)
+    daily_results = pool.starmap_async(check_dailies, runs)
+    country_results = pool.map_async(
+        count_country_file,
+        [os.path.join(countries_dir, f) for f in country_files])
+    daily_results = daily_results.get()
+    country_results = country_results.get()
+    pool.close()
+    pool.join()
+
+    errors = []
+    error_count = 0
+    daily_cases = {}
+    daily_case_count = 0
+    features = 0
+    for r in daily_results:
+        errors += r["errors"]
+        error_count += r["error_count"]
+        features += r["features"]
+        daily_case_count += r["cases"]
+        for (geoid, new) in r["new_by_geoid"].items():
+            daily_cases[geoid] = daily_cases.get(geoid, 0) + new
+    final_totals = daily_results[-1]["totals"] if daily_results else {}
+    # Deltas don't list totals, but the last date still ends with them.
+    total_mismatches = [g for g in set(final_totals) | set(daily_cases)
+                        if final_totals.get(g, 0) != daily_cases.get(g, 0)]
+
+    country_cases = {}
+    country_case_count = 0
+    for (cases, file_count) in country_results:
+        country_case_count += file_count
+        for (geoid, count) in cases.items():
+            country_cases[geoid] = country_cases.get(geoid, 0) + count
+    missing_from_dailies = [g for g in country_cases
+                            if country_cases[g] > daily_cases.get(g, 0)]
+
+    location_info_path = os.path.join(root_dir, "location_info.data")
+    known = set()
+    if os.path.exists(location_info_path):
+        known = set([geoid_key(g) for (g, info) in
+                     location_index.read_entries(location_info_path)])
+    unknown = [g for g in set(daily_cases) | set(country_cases)
+               if geoid_key(g) not in known]
+
+    report = {
+        "dailies": {
+            "files": len(dates),
+            "first_date": dates[0] if dates else None,
+            "last_date": dates[-1] if dates else None,
+            "features": features,
+            "cases": daily_case_count,
+            "locations": len(daily_cases),
+            "error_count": error_count,
+            "errors": errors[:MAX_REPORTED_ERRORS],
+            "total_mismatches": limited(total_mismatches),
+        },
+        "countries": {
+            "files": len(country_files),
+            "cases": country_case_count,
+            "locations": len(country_cases),
+            "more_cases_than_dailies": limited(missing_from_dailies),
+        },
+        "location_info": {
+            "locations": len(known),
+            "unknown_geoids": limited(unknown),
+        },
+    }
+    aggregate_path = os.path.join(root_dir, "aggregate.json")
+    if os.path.exists(aggregate_path):
+        # For reference only: JHU's global counts come from another source.
+        aggregate = read_json(aggregate_path)
+        last = max([d for d in aggregate if aggregate[d]], default=None)
+        report["aggregate"] = {"last_date": last, "cases": sum(
+            [c["cum_conf"] for c in aggregate[last]]) if last else 0}
+    report["ok"] = error_count == 0 and not total_mismatches and \
+        not missing_from_dailies and not unknown and \
+        country_case_count <= daily_case_count
+    report["wall_s"] = round(time.time() - start_time, 3)
+    return report
+
+
+def main(argv):
+    total_includes_new = "--total-excludes-new" not in argv
+    args = [a for a in argv if not a.startswith("--")]
+    report = validate(args[0] if args else ".", total_includes_new)
+    print(json.dumps(report, indent=1, sort_keys=True))
+    return 0 if report["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))